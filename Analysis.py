@@ -7,66 +7,51 @@ This is a temporary script file.
 
 import pandas as pd
 import os
-import matplotlib.pyplot as plt
-import numpy as np
+from Occupancy import countPatientsAtArrival
+from Intervals import buildIntervalIndex, occupancyCurve, INTERVALS
+from Charts import renderCharts
+from Cube import buildCube, rollUp, COUNT
+from Profiling import reportFromArguments
 
-def createGroupedCharts(labels, ax, dataset, disaggregationColumn, countColumn="Count", width=0.2):
-    ind = np.arange(len(labels))
-    axesList = []
-    
-    uniqueDisaggValues = list(dataset[disaggregationColumn].unique())
-    for i in range(len(uniqueDisaggValues)):
-        label = disaggregationColumn + " {}".format(uniqueDisaggValues[i])
-        count = list(dataset.loc[dataset[disaggregationColumn]==uniqueDisaggValues[i]][countColumn])
-        axesList.append(ax.bar(ind - width*(len(uniqueDisaggValues) - (i*2 + 1))/2, count, width, label=label))
-        
-    return axesList
-
-def calculateTotalPatientsInED(dataset):
+def calculateTotalPatientsInED(dataset, startColumn="Arrival Date", endColumn="Depart Actual Date"):
     """Calculate number of patients currently presenting in ED. The start of a presentation is from Arrival Time until Departure time
     
     Input:
         dataset - Generic ED 2009 dataset
+        startColumn - column marking the start of a presentation
+        endColumn - column marking the end of a presentation
         
     Output:
-        Cummulative count of number of patients currently presenting in ED at time of new patient arrival
+        Cummulative count of number of patients currently presenting in ED at time of new patient arrival, added to dataset as TotalPatientsInEDAtArrival
     """
-    dataset["TotalPatientsInEDAtArrival"] = [0 for i in range(len(dataset))]
-    for i in range(1, len(dataset)):
-        currentArrivalDate = dataset.iloc[i]["Arrival Date"]
-        dataset.iloc[i]["TotalPatientsInEDAtArrival"] = len(dataset.loc[(dataset["Depart Actual Date"] > currentArrivalDate) & (dataset["Arrival Date"] < currentArrivalDate)])
-        
-    dataset.insert(len(dataset), "TotalPatientsInEDAtArrival", TotalPatientsInEDAtArrival, inplace=True)
+    dataset["TotalPatientsInEDAtArrival"] = countPatientsAtArrival(dataset, startColumn=startColumn, endColumn=endColumn)
     
     return
 
-Dataset_ED = pd.read_excel("C:\\Users\\jnguyen11\\OneDrive - KPMG\\Desktop\\Stuff\\Generic ED 2009.xlsx", sheet_name="Generic ED Data")
+report, reportPath = reportFromArguments("Analysis")
 
-Dataset_ED["Triage Priority"].value_counts().sort_index().plot(kind="bar", x = "Triage Priority", y="Presentation count", title="Graph to show distribution of triage priorities for a generic ED")
+Dataset_ED = report.run("read source", pd.read_excel, "C:\\Users\\jnguyen11\\OneDrive - KPMG\\Desktop\\Stuff\\Generic ED 2009.xlsx", sheet_name="Generic ED Data")
 
-Dataset_ED["Arrival Hour"] = [d.hour for d in Dataset_ED["Arrival Date"]]
+# presentation counts by arrival hour and triage priority are rolled up from an aggregation cube built in one pass
+Dataset_ED["Arrival Hour"] = Dataset_ED["Arrival Date"].dt.hour
+cube = report.run("aggregation cube", buildCube, Dataset_ED, rowsIn=len(Dataset_ED))
 
-Hour_Triage = Dataset_ED.groupby(["Arrival Hour", "Triage Priority"]).size().reset_index().rename(columns={0:'Count'})
+with report.stage("triage counts", rowsIn=len(Dataset_ED)) as record:
+    TriageCounts = rollUp(cube, ["Triage Priority"])[["Triage Priority", COUNT]].rename(columns={COUNT: "Presentation count"})
 
-fig, ax = plt.subplots(figsize = (15, 10))
+    Hour_Triage = rollUp(cube, ["Arrival Hour", "Triage Priority"])[["Arrival Hour", "Triage Priority", COUNT]]
+    record["rows out"] = len(Hour_Triage)
 
-labels = list(Hour_Triage["Arrival Hour"].unique())
+with report.stage("charts") as record:
+    record["rows out"] = len(renderCharts([{"name": "TriagePriorityDistribution", "kind": "bar", "table": TriageCounts, "x": "Triage Priority", "y": "Presentation count", "title": "Graph to show distribution of triage priorities for a generic ED", "xlabel": "Triage Priority", "ylabel": "Presentation count"},
+                                           {"name": "ArrivalHourTriagePriority", "kind": "groupedBar", "table": Hour_Triage, "labelColumn": "Arrival Hour", "disaggregationColumn": "Triage Priority", "figsize": (15, 10)}]))
 
-ind = np.arange(len(labels))
+report.run("occupancy", calculateTotalPatientsInED, Dataset_ED, rowsIn=len(Dataset_ED))
 
-axesList = createGroupedCharts(labels, ax, Hour_Triage, "Triage Priority")
+WaitByOccupancy = report.run("wait by occupancy", lambda: Dataset_ED[["TotalPatientsInEDAtArrival", "Calculated Arrival-TreatDrNr (mins)"]].groupby(by="TotalPatientsInEDAtArrival").mean().reset_index(), rowsIn=len(Dataset_ED))
 
-ax.set_xticks(ind)
-ax.set_xticklabels(labels)
-ax.legend()
-
-#calculateTotalPatientsInED(Dataset_ED)
-
-TotalPatientsInEDAtArrival = [0 for i in range(len(Dataset_ED))]
-for i in range(1, len(Dataset_ED)):
-    currentArrivalDate = Dataset_ED.iloc[i]["Arrival Date"]
-    TotalPatientsInEDAtArrival[i] = len(Dataset_ED.loc[(Dataset_ED["Depart Actual Date"] > currentArrivalDate) & (Dataset_ED["Arrival Date"] < currentArrivalDate)])
-        
-Dataset_ED["TotalPatientsInEDAtArrival"] = TotalPatientsInEDAtArrival
+# hourly mean number of patients waiting and in ED by triage priority, answered from an interval index instead of masking the dataset for every hour
+intervalIndex = report.run("interval index", buildIntervalIndex, Dataset_ED, rowsIn=len(Dataset_ED))
+HourlyOccupancy = {kind: report.run("{} occupancy curve".format(kind), occupancyCurve, intervalIndex, kind, Dataset_ED["Arrival Date"].min().floor("h"), Dataset_ED["Arrival Date"].max(), freq="1h") for kind in INTERVALS}
 
-Dataset_ED[["TotalPatientsInEDAtArrival", "Calculated Arrival-TreatDrNr (mins)"]].groupby(by="TotalPatientsInEDAtArrival").mean().reset_index()
\ No newline at end of file
+report.write(reportPath)
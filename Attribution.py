@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 24/03/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module attributes, for each patient, which triage priorities "bumped" them i.e. other patients waiting in the same snapshot
+          who were expected to be seen later but were actually seen earlier.
+          The timeline is indexed once by presentation and by snapshot (members sorted by expected Dr seen time) so that every triage
+          level is attributed in a single vectorized pass, optionally sharded by snapshot date across a process pool.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from Occupancy import toEpoch
+
+def indexTimeline(timeline, dataset, triageColumn="TriagePriority"):
+    """Index the ED wait room timeline by snapshot, with presentations identified by their dataset row.
+
+    Input:
+        timeline - ED wait room timeline index, positions into dataset
+        dataset - transformed Generic ED 2009 dataset
+        triageColumn - name of the triage priority column in dataset
+
+    Output:
+        Dictionary of numpy arrays sorted by snapshot then expected Dr seen time.
+        The arrays are snapshot (snapshot id), presentation (dataset row), mrn, visit, triage, expected, actual and day
+    """
+    patient = timeline["Patient"].to_numpy()
+    arrival = dataset["Arrival Date"].to_numpy()[timeline["Snapshot"].to_numpy()]
+    snapshot, _ = pd.factorize(arrival, sort=True)
+    expected, _ = toEpoch(dataset["Expected Dr Seen"])
+    actual, _ = toEpoch(dataset["Dr Seen Date"])
+
+    # a snapshot repeated for patients arriving at the same instant adds nothing to attribution
+    unique = ~pd.DataFrame({"snapshot": snapshot, "presentation": patient}).duplicated().to_numpy()
+    order = np.lexsort((expected[patient[unique]], snapshot[unique]))
+    positions = np.flatnonzero(unique)[order]
+    rows = patient[positions]
+
+    return {
+        "snapshot": snapshot[positions],
+        "presentation": rows,
+        "mrn": dataset["MRN"].to_numpy()[rows],
+        "visit": dataset["Presentation Visit Number"].to_numpy()[rows],
+        "triage": dataset[triageColumn].to_numpy(dtype="int64")[rows],
+        "expected": expected[rows],
+        "actual": actual[rows],
+        "day": pd.DatetimeIndex(arrival[positions]).normalize().to_numpy(),
+    }
+
+def bumpedByPairs(index, targets):
+    """Find every (target presentation, bumping presentation) pair within the indexed snapshots.
+    A presentation bumps a target when they share a snapshot, it has a different MRN and a different Presentation Visit Number,
+    a later expected Dr seen time and an earlier actual Dr seen time.
+
+    Input:
+        index - dictionary of numpy arrays from indexTimeline, sorted by snapshot then expected Dr seen time
+        targets - boolean numpy array over dataset rows flagging the presentations to attribute
+
+    Output:
+        DataFrame of unique (presentation, bumpedBy, triage) rows where triage is the bumping presentation's triage priority
+    """
+    snapshot = index["snapshot"]
+    expected = index["expected"]
+
+    # members of a snapshot are sorted by expected time, so later-expected members are a contiguous run after each row
+    expectedRank = np.unique(expected, return_inverse=True)[1].astype("int64")
+    scale = int(expectedRank.max()) + 2 if len(expectedRank) > 0 else 1
+    key = snapshot.astype("int64") * scale + expectedRank
+    rows = np.flatnonzero(targets[index["presentation"]])
+    first = np.searchsorted(key, key[rows], side="right")
+    last = np.searchsorted(key, (snapshot[rows].astype("int64") + 1) * scale, side="left")
+    lengths = last - first
+
+    targetRows = np.repeat(rows, lengths)
+    offsets = np.arange(int(lengths.sum())) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    candidateRows = np.repeat(first, lengths) + offsets
+
+    keep = (index["actual"][candidateRows] < index["actual"][targetRows]) & (index["mrn"][candidateRows] != index["mrn"][targetRows]) & (index["visit"][candidateRows] != index["visit"][targetRows])
+    pairs = pd.DataFrame({"presentation": index["presentation"][targetRows[keep]], "bumpedBy": index["presentation"][candidateRows[keep]], "triage": index["triage"][candidateRows[keep]]})
+
+    return pairs.drop_duplicates(subset=["presentation", "bumpedBy"], keep="first")
+
+def _shardPairs(shard):
+    """Process pool worker for a shard of the index covering whole snapshots.
+    """
+    index, targets = shard
+
+    return bumpedByPairs(index, targets)
+
+def attributeBumpedBy(dataset, timeline, triageLevels=range(1, 6), triageColumn="TriagePriority", processes=None):
+    """Count, for each patient of the given triage levels, how many patients of each triage priority were seen before them
+    despite being expected to be seen after them in a snapshot they shared. Only patients with LateSeenByDr are attributed.
+
+    Input:
+        dataset - transformed Generic ED 2009 dataset
+        timeline - ED wait room timeline index
+        triageLevels - triage priorities of the patients to attribute
+        triageColumn - name of the triage priority column in dataset
+        processes - number of worker processes to shard snapshot dates across. None runs in the current process
+
+    Output:
+        dataset with BumpedByTriage{n} columns holding the count of bumping patients of triage priority n, left empty where there are none
+    """
+    index = indexTimeline(timeline, dataset, triageColumn)
+
+    targets = (~(dataset["LateSeenByDr"].isna()) & (dataset[triageColumn].isin(list(triageLevels)))).to_numpy()
+
+    if processes is None:
+        pairs = bumpedByPairs(index, targets)
+    else:
+        # snapshots never span two dates, so each shard holds whole snapshots. A pair can still recur on several dates
+        days, dayIds = np.unique(index["day"], return_inverse=True)
+        shards = []
+        for shardDays in np.array_split(np.arange(len(days)), min(len(days), processes * 4)):
+            mask = np.isin(dayIds, shardDays)
+            shards.append(({column: values[mask] for column, values in index.items()}, targets))
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            pairs = pd.concat(list(executor.map(_shardPairs, shards)), ignore_index=True)
+        pairs = pairs.drop_duplicates(subset=["presentation", "bumpedBy"], keep="first")
+
+    counts = pairs.groupby(by=["presentation", "triage"]).size().unstack(fill_value=0)
+    for triage in counts.columns:
+        column = counts[triage]
+        column = column[column > 0]
+        rowCounts = np.full(len(dataset), np.nan)
+        rowCounts[column.index.to_numpy()] = column.to_numpy()
+        if (~np.isnan(rowCounts)).any():
+            dataset["BumpedByTriage{}".format(triage)] = rowCounts
+
+    return dataset
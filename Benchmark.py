@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 11/04/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This script times each Transformation and PopulationAnalysis stage on synthetic datasets of increasing size and reports
+          throughput and peak memory, so scaling regressions can be tracked without patient data.
+          Stages are timed untraced and the process's peak RSS is recorded after each. --trace-memory runs every stage a second time
+          under tracemalloc for its own peak allocation, which tracing slows down too much to time in the same pass.
+          Usage: python Benchmark.py [--sizes 10000 100000 1000000 10000000] [--output benchmark_results.csv] [--resamples 10000] [--trace-memory]
+"""
+
+import argparse
+import gc
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from Synthetic import generateDataset
+from Occupancy import countPatientsAtArrival
+from Timeline import iterateTimeline, buildTimelineIndex, rankTimelineIndex, flagTimelineIndex
+from Schema import compactDataset, compactTimeline, memoryUsage
+from Features import deriveFeatures
+from Attribution import attributeBumpedBy
+from Statistics import defineStrata, runTests
+from Resampling import compareStrata
+from Charts import renderCharts
+from Export import writeExcel, writeCsv, timelineChunks
+from Profiling import peakRSS
+
+SIZES = [10000, 100000, 1000000, 10000000]
+triageTimeLimit = [2, 10, 30, 60, 120]
+# openpyxl writes cells one at a time, so the Excel export is only timed up to this many presentations
+EXCEL_MAX_SIZE = 100000
+
+def timeStage(results, size, stage, rows, function, *args, traceMemory=False, **kwargs):
+    """Run one stage, recording wall time, throughput, the process's peak RSS and optionally the stage's peak traced memory.
+
+    Input:
+        traceMemory - run function a second time under tracemalloc for its peak allocation, which is NaN otherwise. The timed run is never traced
+
+    Output:
+        Return value of function
+    """
+    gc.collect()
+    start = time.perf_counter()
+    value = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    rss = peakRSS()
+
+    traced = np.nan
+    if traceMemory:
+        gc.collect()
+        tracemalloc.start()
+        function(*args, **kwargs)
+        traced = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    results.append({"rows": size, "stage": stage, "seconds": seconds, "rows per second": rows / seconds if seconds > 0 else float("inf"),
+                    "peak RSS (MB)": rss if rss is not None else np.nan, "peak traced memory (MB)": traced})
+    print("{:>10} {:<32} {:>10.3f}s {:>14.0f} rows/s {:>10.1f} MB RSS".format(size, stage, seconds, results[-1]["rows per second"], results[-1]["peak RSS (MB)"])
+          + (" {:>10.1f} MB traced".format(traced) if traceMemory else ""))
+
+    return value
+
+def derivedColumns(dataset):
+    """Derive the columns PopulationAnalysis.py relies on from the transformation stages' outputs.
+    """
+    dataset = deriveFeatures(dataset, triageTimeLimit)
+    dataset["Arrival Month"] = dataset["Arrival Date"].dt.month
+    dataset["Arrival Day Of Week"] = dataset["Arrival Date"].dt.dayofweek
+
+    return dataset
+
+def lateCharts(analysed):
+    """Density charts of LateSeenByDr by TreatedLaterThanOrdering, for the population and triage priorities 3 to 5 as PopulationAnalysis.py declares them.
+    """
+    charts = []
+    for name, population in [("TreatedLaterThanOrdering", analysed)] + [("TreatedLaterThanOrdering_triage{}".format(triage), analysed.loc[analysed["TriagePriority"] == triage]) for triage in range(3, 6)]:
+        late = population.loc[~population["LateSeenByDr"].isna()]
+        groups = [late.loc[late["TreatedLaterThanOrdering"] == flag, "LateSeenByDr"].to_numpy() for flag in (0, 1)]
+        charts.append({"name": name, "kind": "kde", "xlabel": "Late time (mins)", "ylabel": "Probability Density", "textY": 0.02,
+                       "series": [(groups[0], "Not treated later than expected order", "#cccccc"), (groups[1], "Treated later than expected order", "#ffe600")],
+                       "medians": [(np.median(values), color) for values, color in zip(groups, ("#cccccc", "#ffe600")) if len(values)]})
+
+    return charts
+
+def benchmark(size, results, window="7D", resamples=10000, traceMemory=False):
+    """Time every stage on a synthetic dataset of size rows. Timelines of more than a million presentations are built in windows and only counted.
+    """
+    def stage(name, rows, function, *args, **kwargs):
+        return timeStage(results, size, name, rows, function, *args, traceMemory=traceMemory, **kwargs)
+
+    dataset = stage("generate", size, generateDataset, size)
+    dataset = dataset.loc[~dataset["Depart Status Code"].isin(["ZZ", "D"])].reset_index(drop=True)
+    rows = len(dataset)
+
+    stage("occupancy by triage", rows, countPatientsAtArrival, dataset, groupColumn="Triage Priority", groupValues=range(1, 6))
+    stage("occupancy arrival-depart", rows, countPatientsAtArrival, dataset, endColumn="Depart Actual Date")
+    dataset = stage("derived features", rows, derivedColumns, dataset)
+
+    if size > 1000000:
+        stage("timeline (windowed)", rows, lambda: sum(len(block) for block in iterateTimeline(dataset, triageTimeLimit, window)))
+        return
+
+    timeline = stage("timeline", rows, buildTimelineIndex, dataset)
+    timeline = stage("ranking", len(timeline), rankTimelineIndex, timeline, dataset)
+    dataset["TreatedLaterThanOrdering"] = stage("treated later flag", len(timeline), flagTimelineIndex, dataset, timeline)
+    dataset = stage("compact dtypes", rows, compactDataset, dataset)
+    timeline = compactTimeline(timeline)
+    print("{:>10} dataset {:.1f} MB, timeline index {:.1f} MB".format(size, memoryUsage(dataset), memoryUsage(timeline)))
+
+    analysed = dataset.rename(columns={"Triage Priority": "TriagePriority", "Arrival Month": "ArrivalMonth", "Arrival Day Of Week": "ArrivalDayOfWeek"})
+    stage("bumped-by attribution", rows, attributeBumpedBy, analysed, timeline)
+    stage("stratified tests", rows, runTests, analysed, defineStrata(analysed, ["TriagePriority"]), tests=["mannwhitneyu", "ttest", "median", "ols"])
+
+    # the PopulationAnalysis.py stages, the Tukey test and regressions on waits within three standard deviations of the mean
+    bounds = (analysed["LateSeenByDr"].mean() - 3 * analysed["LateSeenByDr"].std(), analysed["LateSeenByDr"].mean() + 3 * analysed["LateSeenByDr"].std())
+    stage("tukey", rows, runTests, analysed, defineStrata(analysed, []), tests=["tukey"], bounds=bounds)
+    stage("regression", rows, runTests, analysed, defineStrata(analysed, []), tests=["lasso", "ols"], bounds=bounds)
+    stage("resampling tests", rows, compareStrata, analysed, "TriagePriority", resamples=resamples)
+
+    # charts and exports are written to a scratch directory, with a new chart cache every run so every chart is rendered
+    with tempfile.TemporaryDirectory() as scratch:
+        charts = lateCharts(analysed)
+        stage("charts", rows, lambda: renderCharts(charts, outputDir=scratch, cacheDir=tempfile.mkdtemp(dir=scratch)))
+
+        def exportTables():
+            return {"Transformed dataset": analysed, "ED Wait Room Timeline": timelineChunks(timeline, analysed, triageColumn="TriagePriority")}
+
+        if size <= EXCEL_MAX_SIZE:
+            stage("excel output", rows + len(timeline), lambda: writeExcel(os.path.join(scratch, "benchmark.xlsx"), exportTables()))
+        stage("csv output", rows + len(timeline), lambda: writeCsv(os.path.join(scratch, "csv"), exportTables()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages on synthetic ED data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--output", default="benchmark_results.csv")
+    parser.add_argument("--resamples", type=int, default=10000, help="bootstrap and permutation resamples of the resampling tests")
+    parser.add_argument("--trace-memory", action="store_true", help="run every stage a second time under tracemalloc for its peak allocation")
+    arguments = parser.parse_args()
+
+    results = []
+    for size in arguments.sizes:
+        benchmark(size, results, resamples=arguments.resamples, traceMemory=arguments.trace_memory)
+    pd.DataFrame(results).to_csv(arguments.output, index=False)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 08/04/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module renders the charts of Analysis.py and PopulationAnalysis.py headlessly on the Agg backend.
+          Charts are declared as dictionaries and rendered together, in parallel worker processes if requested.
+          Kernel density grids are cached by a hash of their input, and a chart is only redrawn when its inputs changed.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+
+THEME = {"axes.facecolor": "#404040", "figure.facecolor": "#404040"}
+CACHE_DIR = ".chart_cache"
+MANIFEST = "manifest.json"
+
+def inputHash(obj):
+    """Hash chart inputs. DataFrames, Series and arrays are hashed by content, other values by their pickled form.
+    """
+    digest = hashlib.sha256()
+    _updateHash(digest, obj)
+
+    return digest.hexdigest()
+
+def _updateHash(digest, obj):
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        digest.update(pickle.dumps(list(obj.columns) if isinstance(obj, pd.DataFrame) else obj.name))
+        digest.update(pd.util.hash_pandas_object(obj, index=True).to_numpy().tobytes())
+    elif isinstance(obj, np.ndarray):
+        digest.update(str(obj.dtype).encode("utf-8"))
+        digest.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        for key in sorted(obj):
+            digest.update(str(key).encode("utf-8"))
+            _updateHash(digest, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _updateHash(digest, item)
+    else:
+        digest.update(pickle.dumps(obj))
+
+def kdeGrid(values, gridSize=200, cut=3, cacheDir=CACHE_DIR):
+    """Gaussian kernel density estimate (Scott's bandwidth) evaluated on a grid, as drawn by seaborn's kdeplot. Cached by the content of values.
+
+    Input:
+        values - 1D array of observations
+        gridSize - number of grid points
+        cut - number of bandwidths the grid extends past the extreme observations
+        cacheDir - directory of the cache
+
+    Output:
+        Tuple of (grid, density) numpy arrays, None when values has fewer than 2 distinct observations as the density is undefined
+    """
+    values = np.asarray(values, dtype="float64")
+    values = values[~np.isnan(values)]
+    if len(np.unique(values)) < 2:
+        return None
+    key = inputHash((values, gridSize, cut))
+    path = os.path.join(cacheDir, "kde-{}.npz".format(key))
+    if os.path.exists(path):
+        cached = np.load(path)
+        return cached["grid"], cached["density"]
+
+    kde = stats.gaussian_kde(values)
+    bandwidth = np.sqrt(kde.covariance.squeeze())
+    grid = np.linspace(values.min() - cut * bandwidth, values.max() + cut * bandwidth, gridSize)
+    density = kde(grid)
+    os.makedirs(cacheDir, exist_ok=True)
+    np.savez(path, grid=grid, density=density)
+
+    return grid, density
+
+def createGroupedCharts(labels, ax, dataset, disaggregationColumn, countColumn="Count", width=0.2):
+    ind = np.arange(len(labels))
+    axesList = []
+
+    uniqueDisaggValues = list(dataset[disaggregationColumn].unique())
+    for i in range(len(uniqueDisaggValues)):
+        label = disaggregationColumn + " {}".format(uniqueDisaggValues[i])
+        count = list(dataset.loc[dataset[disaggregationColumn]==uniqueDisaggValues[i]][countColumn])
+        axesList.append(ax.bar(ind - width*(len(uniqueDisaggValues) - (i*2 + 1))/2, count, width, label=label))
+
+    return axesList
+
+def styleAxes(ax, xlabel, ylabel):
+    """Apply the white on dark grey label and tick styling used by every chart.
+    """
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.xaxis.label.set_color('w')
+    ax.yaxis.label.set_color('w')
+    ax.xaxis.label.set_size(20)
+    ax.yaxis.label.set_size(20)
+    ax.tick_params(axis='x', colors='w')
+    ax.tick_params(axis="both", which="major", labelsize=15)
+    ax.tick_params(axis='y', colors='w')
+    plt.setp(ax.legend().get_texts(), color='w', fontsize=15)
+    ax.grid(False)
+
+def _stackedBar(ax, chart):
+    table = chart["table"]
+    bottom = None
+    for value, color, label in chart["layers"]:
+        layer = table.loc[table[chart["stackColumn"]]==value]
+        ax.bar(layer[chart["x"]].astype(str), layer[chart["y"]], color=color, label=label, bottom=bottom)
+        bottom = layer[chart["y"]].to_numpy() if bottom is None else bottom + layer[chart["y"]].to_numpy()
+
+def _kde(ax, chart):
+    for values, label, color in chart["series"]:
+        estimate = kdeGrid(values, cacheDir=chart["cacheDir"])
+        # empty or constant series are skipped, as seaborn's kdeplot does, rather than failing the batch
+        if estimate is None:
+            continue
+        grid, density = estimate
+        ax.plot(grid, density, color=color, label=label)
+        ax.fill_between(grid, density, color=color, alpha=0.25)
+    for median, color in chart.get("medians", []):
+        ax.axvline(x=median, color=color)
+        ax.text(median + 10, chart["textY"], str(int(median)), color='w', fontsize=15)
+
+def _groupedBar(ax, chart):
+    table = chart["table"]
+    labels = list(table[chart["labelColumn"]].unique())
+    createGroupedCharts(labels, ax, table, chart["disaggregationColumn"], countColumn=chart.get("countColumn", "Count"))
+    ax.set_xticks(np.arange(len(labels)))
+    ax.set_xticklabels(labels)
+
+def _bar(ax, chart):
+    table = chart["table"]
+    ax.bar(table[chart["x"]].astype(str), table[chart["y"]], color=chart.get("color", "#ffe600"), label=chart.get("label"))
+
+RENDERERS = {"stackedBar": _stackedBar, "kde": _kde, "groupedBar": _groupedBar, "bar": _bar}
+
+def renderChart(chart):
+    """Render one declared chart to its png file.
+
+    Input:
+        chart - dictionary with name, kind (one of RENDERERS), file, the kind's inputs and optional title, xlabel, ylabel, figsize
+
+    Output:
+        Name of the chart
+    """
+    with plt.rc_context(THEME):
+        fig, ax = plt.subplots(figsize=chart.get("figsize", (15, 12)))
+        RENDERERS[chart["kind"]](ax, chart)
+        if chart.get("title"):
+            ax.set_title(chart["title"], color='w')
+        styleAxes(ax, chart.get("xlabel", ""), chart.get("ylabel", ""))
+        fig.savefig(chart["file"], dpi=fig.dpi, bbox_inches='tight')
+        plt.close(fig)
+
+    return chart["name"]
+
+def renderCharts(charts, outputDir=".", cacheDir=CACHE_DIR, processes=None):
+    """Render declared charts whose inputs changed since they were last rendered.
+
+    Input:
+        charts - list of chart dictionaries, see renderChart
+        outputDir - directory the png files are written to
+        cacheDir - directory of the density and chart caches
+        processes - number of worker processes to render in. None renders in the current process
+
+    Output:
+        List of names of the charts rendered
+    """
+    os.makedirs(cacheDir, exist_ok=True)
+    manifestPath = os.path.join(cacheDir, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifestPath):
+        with open(manifestPath) as manifestFile:
+            manifest = json.load(manifestFile)
+
+    pending = []
+    hashes = {}
+    for chart in charts:
+        chart = dict(chart, file=os.path.join(outputDir, chart.get("file", chart["name"] + ".png")), cacheDir=cacheDir)
+        hashes[chart["name"]] = inputHash({key: value for key, value in chart.items() if key != "cacheDir"})
+        if manifest.get(chart["name"]) != hashes[chart["name"]] or not os.path.exists(chart["file"]):
+            pending.append(chart)
+
+    if processes is None or len(pending) < 2:
+        rendered = [renderChart(chart) for chart in pending]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            rendered = list(executor.map(renderChart, pending))
+
+    for name in rendered:
+        manifest[name] = hashes[name]
+    with open(manifestPath, "w") as manifestFile:
+        json.dump(manifest, manifestFile, indent=1)
+
+    return rendered
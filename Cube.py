@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 28/04/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module materialises an aggregation cube over arrival hour, day of week, month, triage priority, LateFlag and TreatedLaterThanOrdering.
+          Every cell holds the number of presentations and, per wait time measure, the count and sum of the waits and a quantile sketch:
+          a histogram over buckets of geometrically growing width, so any quantile is estimated within the sketch's relative accuracy.
+          Every dimension has a last slot for rows with a missing value, e.g. the LateFlag of a patient not yet seen, so every row is counted.
+          The cube is built in one pass of bincounts over the rows. Counts and sums are a dense array per statistic and sketches are kept for
+          occupied cells only, so a roll-up to any subset of dimensions is a sum over the other axes and takes the same time whatever the number
+          of rows. Roll-ups return every combination of dimension values, including empty ones. Cubes are saved as .npy files next to the
+          transformed dataset and memory mapped when loaded. Cubes built with the same dimensions and sketch buckets add up cell by cell, so
+          appended rows are added to a stored cube, and updated rows moved between cells, without rebuilding it.
+          Dimension and measure columns missing from a dataset are skipped.
+"""
+
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+# dimension column to the values it takes. Every dimension has one more slot, after its values, for rows with a missing or other value
+CUBE_DIMENSIONS = {
+    "Arrival Hour": np.arange(24),
+    "Arrival Day Of Week": np.arange(7),
+    "Arrival Month": np.arange(1, 13),
+    "Triage Priority": np.arange(1, 6),
+    "LateFlag": np.arange(2),
+    "TreatedLaterThanOrdering": np.arange(2),
+}
+# measure name to the column of wait times in minutes it summarises
+CUBE_MEASURES = {"Wait for Dr (mins)": "TimeDiff Arrival-TreatDrNr (mins)", "Length of stay (mins)": "Calculated TimeDiff Arrival-Actual Depart (mins)"}
+AGGREGATION_CUBE = "Aggregation Cube"
+# bumped whenever the stored cube layout changes, cubes stored by an earlier version are rebuilt
+CUBE_VERSION = 2
+COUNT = "Count"
+
+def _bucket(values, gamma, buckets):
+    """Sketch bucket of each value: 0 below one minute, k >= 1 for [gamma^(k-1), gamma^k) minutes, longer waits in the last bucket.
+    """
+    scaled = np.log(np.maximum(values, 1)) / np.log(gamma)
+
+    return np.where(values < 1, 0, np.minimum(1 + np.floor(scaled).astype("int64"), buckets - 1))
+
+def _shape(cube):
+    return tuple(len(values) + 1 for values in cube["domains"])
+
+def _sparseSketch(cells, buckets, width):
+    """Sketch rows of the occupied cells, from the flat cell and bucket of every value.
+
+    Output:
+        Tuple of (sorted occupied flat cells, int32 matrix of a row of bucket counts per occupied cell)
+    """
+    occupied, rows = np.unique(cells, return_inverse=True)
+
+    return occupied, np.bincount(rows * width + buckets, minlength=len(occupied) * width).reshape(len(occupied), width).astype("int32")
+
+def buildCube(dataset, dimensions=CUBE_DIMENSIONS, measures=CUBE_MEASURES, relativeAccuracy=0.02, maxMinutes=2**14):
+    """Aggregate dataset into a cube in one pass.
+
+    Input:
+        dataset - transformed dataset
+        dimensions - dictionary of dimension column to the values it takes
+        measures - dictionary of measure name to column of wait times in minutes
+        relativeAccuracy - relative error of quantiles estimated from the sketches
+        maxMinutes - waits above this many minutes share the last sketch bucket
+
+    Output:
+        Dictionary holding dimensions, domains (values of each dimension), measures, gamma (sketch bucket growth), buckets, rows and arrays:
+        Count and, per measure, "<measure> count" and "<measure> sum" with one axis per dimension, each one longer than the dimension's values
+        for its missing slot, and "<measure> sketch cells" (occupied flat cells) with "<measure> sketch" (bucket counts per occupied cell)
+    """
+    dimensions = {column: np.asarray(values) for column, values in dimensions.items() if column in dataset.columns}
+    measures = {name: column for name, column in measures.items() if column in dataset.columns}
+    gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy)
+    buckets = 2 + int(np.floor(np.log(maxMinutes) / np.log(gamma)))
+    cube = {"dimensions": list(dimensions), "domains": list(dimensions.values()), "measures": list(measures), "gamma": gamma, "buckets": buckets, "rows": len(dataset)}
+    shape = _shape(cube)
+    cells = int(np.prod(shape))
+
+    # flat cell of every row, a missing or other value of a dimension takes its last slot
+    codes = []
+    for column, values in dimensions.items():
+        rowValues = dataset[column].to_numpy(dtype="float64", na_value=np.nan)
+        positions = np.minimum(np.searchsorted(values, rowValues), len(values) - 1)
+        codes.append(np.where(values[positions] == rowValues, positions, len(values)))
+    cell = np.ravel_multi_index(codes, shape) if codes else np.zeros(len(dataset), dtype="int64")
+
+    arrays = {COUNT: np.bincount(cell, minlength=cells).reshape(shape).astype("int64")}
+    for name, column in measures.items():
+        waits = dataset[column].to_numpy(dtype="float64", na_value=np.nan)
+        present = ~np.isnan(waits)
+        arrays[name + " count"] = np.bincount(cell[present], minlength=cells).reshape(shape).astype("int64")
+        arrays[name + " sum"] = np.bincount(cell[present], weights=waits[present], minlength=cells).reshape(shape)
+        arrays[name + " sketch cells"], arrays[name + " sketch"] = _sparseSketch(cell[present], _bucket(waits[present], gamma, buckets), buckets)
+    cube["arrays"] = arrays
+
+    return cube
+
+def addCubes(cubes, signs=None):
+    """Sum cubes cell by cell, e.g. a stored cube and the cube of newly appended rows.
+
+    Input:
+        cubes - list of cubes from buildCube or loadCube with the same dimensions, measures and sketch buckets
+        signs - 1 or -1 per cube, defaults to all 1. A cube given -1 takes its rows out, e.g. the earlier values of updated rows
+
+    Output:
+        Cube whose cells hold the sums of the cells of cubes
+    """
+    signs = [1] * len(cubes) if signs is None else signs
+    first = cubes[0]
+    for cube in cubes[1:]:
+        if (cube["dimensions"], cube["measures"], cube["gamma"], cube["buckets"]) != (first["dimensions"], first["measures"], first["gamma"], first["buckets"]) \
+                or any(not np.array_equal(values, other) for values, other in zip(cube["domains"], first["domains"])):
+            raise ValueError("Cubes with different dimensions, measures or sketch buckets can not be added")
+
+    arrays = {}
+    for name in first["arrays"]:
+        if name.endswith(" sketch cells"):
+            continue
+        if name.endswith(" sketch"):
+            # rows of the same occupied cell are summed, cells left empty are dropped
+            cells = np.concatenate([np.asarray(cube["arrays"][name + " cells"]) for cube in cubes])
+            sketch = np.concatenate([sign * np.asarray(cube["arrays"][name], dtype="int64") for cube, sign in zip(cubes, signs)])
+            order = np.argsort(cells, kind="stable")
+            occupied, starts = np.unique(cells[order], return_index=True)
+            summed = np.add.reduceat(sketch[order], starts, axis=0) if len(occupied) else sketch[:0]
+            keep = summed.any(axis=1)
+            arrays[name + " cells"], arrays[name] = occupied[keep], summed[keep].astype("int32")
+        else:
+            arrays[name] = sum(sign * np.asarray(cube["arrays"][name]) for cube, sign in zip(cubes, signs))
+
+    return dict(first, rows=sum(sign * cube["rows"] for cube, sign in zip(cubes, signs)), arrays=arrays)
+
+def sketchQuantiles(sketch, gamma, quantiles):
+    """Estimate quantiles from sketches, the last axis holding the buckets.
+
+    Output:
+        Array of shape sketch.shape[:-1] + (len(quantiles),), NaN where a sketch is empty
+    """
+    cumulative = np.cumsum(sketch, axis=-1)
+    total = cumulative[..., -1:]
+    # bucket k >= 1 is represented by the value within the relative accuracy of all its values, bucket 0 by 0 minutes
+    representatives = np.concatenate([[0.0], 2 * gamma ** np.arange(1, sketch.shape[-1]) / (gamma + 1)])
+    estimates = []
+    for quantile in quantiles:
+        rank = np.floor(quantile * (total - 1))
+        bucket = (cumulative > rank).argmax(axis=-1)
+        estimates.append(np.where(total[..., 0] > 0, representatives[bucket], np.nan))
+
+    return np.stack(estimates, axis=-1)
+
+def rollUp(cube, by, where=None, quantiles=(0.5, 0.9), missing=False):
+    """Aggregate the cube to the dimensions in by.
+
+    Input:
+        cube - cube from buildCube or loadCube
+        by - list of dimensions to keep, in output column order
+        where - optional dictionary of dimension to a value or list of values to keep, e.g. {"Triage Priority": [3, 4]}. None selects the missing slot
+        quantiles - quantiles of each measure to estimate
+        missing - keep a row, labelled NaN, for the missing slot of each dimension in by. Like groupby, rows with a missing value of a dimension
+                  in by are otherwise left out. Dimensions not in by are summed over all their slots
+
+    Output:
+        DataFrame with a row per combination of the values of by, ordered by by, and columns
+        Count, "<measure> count", "<measure> sum", "<measure> mean" and "<measure> p<100 x quantile>" per measure
+    """
+    shape = _shape(cube)
+    # slots selected along every axis
+    selected = [np.arange(size) for size in shape]
+    for name, values in (where or {}).items():
+        axis = cube["dimensions"].index(name)
+        values = list(np.atleast_1d(np.asarray(values, dtype=object)))
+        keep = np.isin(cube["domains"][axis], [value for value in values if not pd.isna(value)])
+        selected[axis] = np.flatnonzero(np.append(keep, any(pd.isna(value) for value in values)))
+    axes = [cube["dimensions"].index(name) for name in by]
+    if not missing:
+        for axis in axes:
+            selected[axis] = selected[axis][selected[axis] < shape[axis] - 1]
+    others = tuple(axis for axis in range(len(shape)) if axis not in axes)
+    targets = [len(selected[axis]) for axis in axes]
+
+    def aggregate(array):
+        for axis in range(len(shape)):
+            if len(selected[axis]) < shape[axis]:
+                array = np.take(array, selected[axis], axis=axis)
+        # sum the other dimensions, then put the kept ones in the order of by
+        array = np.asarray(array).sum(axis=others)
+
+        return np.transpose(array, list(np.argsort(np.argsort(axes)))).reshape(-1)
+
+    def aggregateSketch(occupied, sketch):
+        # position of every occupied cell along each axis within the selected slots, cells outside them are dropped
+        coordinates = np.unravel_index(occupied, shape)
+        keep = np.ones(len(occupied), dtype=bool)
+        positions = []
+        for axis in range(len(shape)):
+            position = np.minimum(np.searchsorted(selected[axis], coordinates[axis]), len(selected[axis]) - 1)
+            keep &= selected[axis][position] == coordinates[axis] if len(selected[axis]) else False
+            positions.append(position)
+        result = np.zeros((int(np.prod(targets)), sketch.shape[1]), dtype="int64")
+        if not keep.any():
+            return result
+        target = np.ravel_multi_index([positions[axis][keep] for axis in axes], targets) if axes else np.zeros(int(keep.sum()), dtype="int64")
+        order = np.argsort(target, kind="stable")
+        rows, starts = np.unique(target[order], return_index=True)
+        grouped = np.asarray(sketch)[np.flatnonzero(keep)[order]]
+        # summing contiguous blocks is faster than reduceat while there are few target cells
+        if len(rows) <= 1024:
+            for row, start, stop in zip(rows, starts, np.append(starts[1:], len(grouped))):
+                result[row] = grouped[start:stop].sum(axis=0, dtype="int64")
+        else:
+            result[rows] = np.add.reduceat(grouped, starts, axis=0, dtype="int64")
+
+        return result
+
+    if by:
+        labels = [np.append(cube["domains"][axis].astype("float64"), np.nan)[selected[axis]] for axis in axes]
+        table = pd.MultiIndex.from_product(labels, names=list(by)).to_frame(index=False)
+        if not missing:
+            table = table.astype({name: cube["domains"][axis].dtype for name, axis in zip(by, axes)})
+    else:
+        table = pd.DataFrame(index=[0])
+    table[COUNT] = aggregate(cube["arrays"][COUNT])
+    for name in cube["measures"]:
+        counts = aggregate(cube["arrays"][name + " count"])
+        sums = aggregate(cube["arrays"][name + " sum"])
+        table[name + " count"] = counts
+        table[name + " sum"] = sums
+        table[name + " mean"] = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+        estimates = sketchQuantiles(aggregateSketch(cube["arrays"][name + " sketch cells"], cube["arrays"][name + " sketch"]), cube["gamma"], quantiles)
+        for position, quantile in enumerate(quantiles):
+            table["{} p{:g}".format(name, 100 * quantile)] = estimates[:, position]
+
+    return table
+
+def saveCube(cube, storeDir, key):
+    """Write a cube to the store under key as .npy files and a JSON description. The directory is replaced as a whole.
+    """
+    path = os.path.join(storeDir, key, AGGREGATION_CUBE)
+    os.makedirs(path + ".tmp", exist_ok=True)
+    names = list(cube["arrays"])
+    for number, name in enumerate(names):
+        np.save(os.path.join(path + ".tmp", "{}.npy".format(number)), cube["arrays"][name])
+    description = {"version": CUBE_VERSION, "dimensions": cube["dimensions"], "domains": [values.tolist() for values in cube["domains"]], "measures": cube["measures"],
+                   "gamma": cube["gamma"], "buckets": cube["buckets"], "rows": cube["rows"], "arrays": names}
+    with open(os.path.join(path + ".tmp", "cube.json"), "w") as descriptionFile:
+        json.dump(description, descriptionFile)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(path + ".tmp", path)
+
+    return
+
+def loadCube(storeDir, key, memoryMap=True):
+    """Load a cube stored under key, or None if there is none or it was stored by an earlier version.
+
+    Input:
+        memoryMap - memory map the arrays instead of reading them into memory. Read a cube that is about to be saved over into memory,
+                    as Windows can not remove the files of a mapped cube
+    """
+    path = os.path.join(storeDir, key, AGGREGATION_CUBE)
+    if not os.path.exists(os.path.join(path, "cube.json")):
+        return None
+    with open(os.path.join(path, "cube.json")) as descriptionFile:
+        description = json.load(descriptionFile)
+    if description.get("version") != CUBE_VERSION:
+        return None
+
+    arrays = {name: np.load(os.path.join(path, "{}.npy".format(number)), mmap_mode="r" if memoryMap else None) for number, name in enumerate(description["arrays"])}
+
+    return {"dimensions": description["dimensions"], "domains": [np.asarray(values) for values in description["domains"]], "measures": description["measures"],
+            "gamma": description["gamma"], "buckets": description["buckets"], "rows": description["rows"], "arrays": arrays}
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 24/04/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module exports result tables to Excel workbooks and gzip CSV files chunk by chunk, so an export holds one chunk of rows in memory at a time.
+          Workbooks are written with openpyxl's write-only mode and tables longer than an Excel sheet continue on numbered sheets.
+          CSV chunks are formatted and gzip compressed in a process pool and appended in order as gzip members, which read back as one file.
+          Tables are DataFrames or iterables of DataFrame chunks, e.g. timelineChunks, which expands the ED wait room timeline index a chunk at a time.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import os
+import pandas as pd
+from openpyxl import Workbook
+from Timeline import expandTimeline
+
+# Excel's row limit per sheet, including the header row
+EXCEL_MAX_ROWS = 1048576
+# Excel's length limit of sheet names
+SHEET_NAME_LENGTH = 31
+CHUNK_ROWS = 50000
+EXPORT_DIR = "exports"
+
+def tableChunks(table, chunkRows=CHUNK_ROWS):
+    """Split a DataFrame into chunks of at most chunkRows rows. An empty table gives one empty chunk so its header is still written.
+    """
+    if len(table) == 0:
+        yield table
+    for start in range(0, len(table), chunkRows):
+        yield table.iloc[start:start + chunkRows]
+
+def timelineChunks(timelineIndex, dataset, chunkRows=CHUNK_ROWS, triageColumn="Triage Priority"):
+    """Expand an ED wait room timeline index chunk by chunk, giving the chunks of expandTimeline(timelineIndex, dataset, triageColumn).
+    """
+    for chunk in tableChunks(timelineIndex, chunkRows):
+        yield expandTimeline(chunk, dataset, triageColumn=triageColumn)
+
+def _chunks(table, chunkRows):
+    return tableChunks(table, chunkRows) if isinstance(table, pd.DataFrame) else iter(table)
+
+def _cellValues(values):
+    """Python values of a column with missing values as None, which openpyxl writes as empty cells.
+    """
+    cells = values.astype(object).to_numpy(copy=True)
+    cells[values.isna().to_numpy()] = None
+
+    return cells.tolist()
+
+def _sheetName(name, part):
+    suffix = "" if part == 1 else " {}".format(part)
+
+    return name[:SHEET_NAME_LENGTH - len(suffix)] + suffix
+
+def writeExcel(path, tables, chunkRows=CHUNK_ROWS, maxRows=EXCEL_MAX_ROWS):
+    """Write tables to an Excel workbook, each on its own sheet, in constant memory.
+
+    Input:
+        path - path of the workbook
+        tables - dictionary of sheet name to DataFrame or iterable of DataFrame chunks with the same columns. Indexes are not written
+        chunkRows - rows per chunk when a table is a DataFrame
+        maxRows - rows per sheet including the header. Longer tables continue on sheets named "<sheet name> 2", "<sheet name> 3", ...
+
+    Output:
+        Dictionary of sheet name to list of the sheets it was written to
+    """
+    workbook = Workbook(write_only=True)
+    sheets = {}
+    for name, table in tables.items():
+        sheets[name] = []
+        header, sheet, rows = None, None, maxRows
+        for chunk in _chunks(table, chunkRows):
+            if header is None:
+                header = [str(column) for column in chunk.columns]
+            cells = list(zip(*[_cellValues(chunk[column]) for column in chunk.columns])) if len(chunk.columns) else [()] * len(chunk)
+            start = 0
+            # a table always gets its first sheet, even without rows
+            while start < len(cells) or sheet is None:
+                if rows == maxRows:
+                    sheets[name].append(_sheetName(name, len(sheets[name]) + 1))
+                    sheet = workbook.create_sheet(sheets[name][-1])
+                    sheet.append(header)
+                    rows = 1
+                stop = min(len(cells), start + maxRows - rows)
+                for row in cells[start:stop]:
+                    sheet.append(row)
+                rows += stop - start
+                start = stop
+        if sheet is None:
+            sheets[name].append(_sheetName(name, 1))
+            workbook.create_sheet(sheets[name][-1])
+    workbook.save(path)
+
+    return sheets
+
+def _compressChunk(task):
+    """Format a chunk as CSV and compress it as one gzip member.
+    """
+    chunk, header = task
+    if len(chunk.columns) == 0:
+        return gzip.compress(b"")
+
+    return gzip.compress(chunk.to_csv(index=False, header=header).encode("utf-8"))
+
+def _pieces(table, chunkRows, maxRows):
+    """Cut the chunks of a table at file boundaries, tagging the pieces that start a new file. The first piece always starts one,
+    and a table without chunks gives one piece without columns, so its first file is still written, empty.
+    """
+    rows = None
+    for chunk in _chunks(table, chunkRows):
+        start = 0
+        while start < len(chunk) or rows is None:
+            newFile = rows is None or (maxRows is not None and rows == maxRows)
+            if newFile:
+                rows = 0
+            stop = len(chunk) if maxRows is None else min(len(chunk), start + maxRows - rows)
+            yield chunk.iloc[start:stop], newFile
+            rows += stop - start
+            start = stop
+    if rows is None:
+        yield pd.DataFrame(), True
+
+def writeCsv(directory, tables, chunkRows=CHUNK_ROWS, maxRows=None, processes=None):
+    """Write tables to gzip CSV files, formatting and compressing chunks in a process pool.
+
+    Input:
+        directory - directory the files are written to, created if missing
+        tables - dictionary of file name (without extension) to DataFrame or iterable of DataFrame chunks with the same columns
+        chunkRows - rows per chunk when a table is a DataFrame
+        maxRows - data rows per file, None writes every table to a single "<name>.csv.gz". Otherwise files are named "<name>_1.csv.gz", "<name>_2.csv.gz", ...
+        processes - number of worker processes. None compresses in the current process
+
+    Output:
+        Dictionary of table name to list of the paths it was written to
+    """
+    os.makedirs(directory, exist_ok=True)
+    executor = ProcessPoolExecutor(max_workers=processes) if processes is not None else None
+    # at most two chunks per worker are in flight, so memory does not grow with the table
+    inFlight = 2 * processes if processes is not None else 0
+    paths = {}
+    try:
+        for name, table in tables.items():
+            paths[name] = []
+            output = None
+            pending = deque()
+            pieces = _pieces(table, chunkRows, maxRows)
+            while True:
+                piece = next(pieces, None)
+                if piece is not None:
+                    pending.append((executor.submit(_compressChunk, piece) if executor is not None else _compressChunk(piece), piece[1]))
+                # write finished chunks in order, all of them once the table is exhausted
+                while len(pending) > (inFlight if piece is not None else 0):
+                    compressed, newFile = pending.popleft()
+                    if newFile:
+                        if output is not None:
+                            output.close()
+                        suffix = "" if maxRows is None else "_{}".format(len(paths[name]) + 1)
+                        paths[name].append(os.path.join(directory, "{}{}.csv.gz".format(name, suffix)))
+                        output = open(paths[name][-1], "wb")
+                    output.write(compressed.result() if executor is not None else compressed)
+                if piece is None:
+                    break
+            output.close()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return paths
+
+def readCsv(paths):
+    """Read the files of one table written by writeCsv back into a DataFrame.
+    """
+    return pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
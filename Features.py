@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 14/04/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module derives expected Dr seen times, wait durations and lateness flags as whole-column operations over int64 epoch times.
+          Triage time limits are looked up from an array indexed by triage priority, so lateness can be re-derived under several
+          triage guideline tables in one pass without reloading data.
+"""
+
+import numpy as np
+import pandas as pd
+from Occupancy import toEpoch
+
+NANOSECONDS_PER_MINUTE = 60 * 10**9
+
+def limitLookup(triageTimeLimit):
+    """Build a lookup array of minutes indexed by triage priority. Priorities without a limit map to NaN.
+
+    Input:
+        triageTimeLimit - list of minutes within which triage priorities 1 to n should be seen
+
+    Output:
+        float64 numpy array of length n + 1, index 0 is NaN
+    """
+    return np.concatenate([[np.nan], np.asarray(triageTimeLimit, dtype="float64")])
+
+def _triageLimits(triage, lookup):
+    """Look up the time limit of every row's triage priority, NaN for missing or unknown priorities.
+    """
+    triage = pd.to_numeric(triage, errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+    valid = ~np.isnan(triage) & (triage >= 1) & (triage < len(lookup)) & (triage == np.round(triage))
+    limits = np.full(len(triage), np.nan)
+    limits[valid] = lookup[triage[valid].astype("int64")]
+
+    return limits
+
+def minutesBetween(dataset, startColumn, endColumn):
+    """Minutes from startColumn to endColumn including whole days, NaN where either is missing.
+    """
+    start, startNaT = toEpoch(dataset[startColumn])
+    end, endNaT = toEpoch(dataset[endColumn])
+    minutes = (end - start) / NANOSECONDS_PER_MINUTE
+    minutes[startNaT | endNaT] = np.nan
+
+    return minutes
+
+def _expected(arrival, arrivalNaT, limits):
+    expected = np.full(len(arrival), np.datetime64("NaT"), dtype="datetime64[ns]")
+    valid = ~arrivalNaT & ~np.isnan(limits)
+    expected[valid] = (arrival[valid] + (limits[valid] * NANOSECONDS_PER_MINUTE).astype("int64")).view("datetime64[ns]")
+
+    return expected
+
+def expectedDrSeen(dataset, triageTimeLimit):
+    """Calculate the time each patient is expected to be seen by a doctor given their triage priority.
+
+    Input:
+        dataset - Generic ED 2009 dataset
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+
+    Output:
+        pandas Series of expected Dr seen datetimes, NaT for unknown triage priorities
+    """
+    arrival, arrivalNaT = toEpoch(dataset["Arrival Date"])
+    limits = _triageLimits(dataset["Triage Priority"], limitLookup(triageTimeLimit))
+
+    return pd.Series(_expected(arrival, arrivalNaT, limits), index=dataset.index, name="Expected Dr Seen")
+
+def _lateFlag(lateSeenByDr):
+    return np.where(np.isnan(lateSeenByDr), np.nan, (lateSeenByDr > 0).astype("float64"))
+
+def deriveFeatures(dataset, triageTimeLimit):
+    """Add expected Dr seen time, wait durations, duration checks and lateness columns to the dataset.
+
+    Input:
+        dataset - Generic ED 2009 dataset
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+
+    Output:
+        dataset with Expected Dr Seen, TimeDiff Arrival-TreatDrNr (mins), Calculated TimeDiff TreatDrNr-Act. Depart (mins),
+        Check TreatDrNr-Act. Depart, Calculated TimeDiff Arrival-Actual Depart (mins), Check Arrival-Actual Depart, LateSeenByDr and LateFlag
+    """
+    limits = _triageLimits(dataset["Triage Priority"], limitLookup(triageTimeLimit))
+
+    dataset["Expected Dr Seen"] = expectedDrSeen(dataset, triageTimeLimit)
+
+    # calculate total wait time between arrival and first doctor inspection
+    dataset["TimeDiff Arrival-TreatDrNr (mins)"] = minutesBetween(dataset, "Arrival Date", "Dr Seen Date")
+
+    # test calculations of minutes for arrival - departure and arrival - doctor inspection
+    dataset["Calculated TimeDiff TreatDrNr-Act. Depart (mins)"] = minutesBetween(dataset, "Dr Seen Date", "Depart Actual Date")
+    dataset["Check TreatDrNr-Act. Depart"] = dataset["Calculated TimeDiff TreatDrNr-Act. Depart (mins)"] == dataset["TimeDiff TreatDrNr-Act. Depart (mins)"]
+    dataset["Calculated TimeDiff Arrival-Actual Depart (mins)"] = minutesBetween(dataset, "Arrival Date", "Depart Actual Date")
+    dataset["Check Arrival-Actual Depart"] = dataset["Calculated TimeDiff Arrival-Actual Depart (mins)"] == dataset["TimeDiff Arrival-Actual Depart (mins)"]
+
+    # difference between triage priority time to be seen by a doctor recommendation and dataset, and whether a person was late being seen
+    dataset["LateSeenByDr"] = dataset["TimeDiff Arrival-TreatDrNr (mins)"].to_numpy() - limits
+    dataset["LateFlag"] = _lateFlag(dataset["LateSeenByDr"].to_numpy())
+
+    return dataset
+
+def deriveLateness(dataset, guidelines):
+    """Derive expected Dr seen time, LateSeenByDr and LateFlag under several triage guideline tables at once.
+
+    Input:
+        dataset - Generic ED 2009 dataset
+        guidelines - dictionary of guideline name to list of minutes within which triage priorities 1 to n should be seen
+
+    Output:
+        DataFrame aligned with dataset with "Expected Dr Seen {name}", "LateSeenByDr {name}" and "LateFlag {name}" columns per guideline
+    """
+    names = list(guidelines)
+    width = max(len(limits) for limits in guidelines.values())
+    # one row per guideline, padded with NaN for priorities a guideline does not define
+    lookup = np.full((len(names), width + 1), np.nan)
+    for row, name in enumerate(names):
+        lookup[row, 1:len(guidelines[name]) + 1] = guidelines[name]
+
+    triage = pd.to_numeric(dataset["Triage Priority"], errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+    valid = ~np.isnan(triage) & (triage >= 1) & (triage <= width) & (triage == np.round(triage))
+    index = np.where(valid, np.nan_to_num(triage), 0).astype("int64")
+    limits = lookup[:, index]
+
+    arrival, arrivalNaT = toEpoch(dataset["Arrival Date"])
+    waited = minutesBetween(dataset, "Arrival Date", "Dr Seen Date")
+    late = waited[np.newaxis, :] - limits
+
+    columns = {}
+    for row, name in enumerate(names):
+        columns["Expected Dr Seen {}".format(name)] = _expected(arrival, arrivalNaT, limits[row])
+        columns["LateSeenByDr {}".format(name)] = late[row]
+        columns["LateFlag {}".format(name)] = _lateFlag(late[row])
+
+    return pd.DataFrame(columns, index=dataset.index)
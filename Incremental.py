@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 30/03/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module appends newly arrived ED records to an already transformed dataset and timeline without recomputing the history.
+          Only patients still waiting to be seen by a doctor at the watermark (the latest arrival already transformed) can take part in
+          snapshots after it, so they are kept as state and every new count, timeline row, ranking and flag is derived from state + new records.
+          The state also holds the stored row positions of the waiting patients, so new timeline index rows point at the stored dataset.
+          The incremental store keeps the dataset as appended parts, and waiting patients flagged treated later by a later append are recorded
+          as their positions in a small table of their own, applied when the store is loaded, so earlier parts are never rewritten.
+"""
+
+import json
+import os
+import numpy as np
+import pandas as pd
+from Timeline import flagTimelineIndex
+from Store import saveTables, loadTables, DATASET_TABLE, TIMELINE_TABLE
+
+STATE_TABLE = "Incremental State"
+# stored row positions of presentations newly treated later than their ordering
+REFLAGGED_TABLE = "Reflagged Rows"
+# bumped whenever the stored state or incremental store layout changes, stores written by an earlier version are reseeded
+STATE_VERSION = 3
+
+def incrementalState(Dataset_ED, watermark=None):
+    """Extract the state needed to append records after the watermark.
+
+    Input:
+        Dataset_ED - transformed dataset as stored
+        watermark - latest arrival already transformed. Defaults to the latest Arrival Date of Dataset_ED
+
+    Output:
+        Dictionary with watermark, waiting i.e. the transformed rows of patients not yet seen by a doctor at the watermark,
+        positions i.e. their row positions in Dataset_ED, and rows i.e. the number of rows of Dataset_ED
+    """
+    if watermark is None:
+        watermark = Dataset_ED["Arrival Date"].max()
+    positions = np.flatnonzero((Dataset_ED["Dr Seen Date"] > watermark).to_numpy())
+
+    return {"watermark": pd.Timestamp(watermark), "waiting": Dataset_ED.iloc[positions].reset_index(drop=True), "positions": positions, "rows": len(Dataset_ED)}
+
+def transformIncrement(newRecords, state, triageTimeLimit, transformDataset):
+    """Transform records that arrived after the watermark. The result matches the corresponding rows of a full recompute over history + newRecords.
+    Records of patients already transformed are assumed final i.e. a waiting patient's Dr Seen Date does not change.
+
+    Input:
+        newRecords - untransformed Generic ED records, all arriving strictly after the watermark
+        state - state from incrementalState
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+        transformDataset - transformation applied to state + newRecords, Transformation.transformDataset or for multi-site records
+                           Partition.transformPartitioned with it, matching the transformation of the stored rows
+
+    Output:
+        Tuple of (transformed new rows, new timeline index rows with positions into the stored dataset followed by the new rows,
+        presentations in state newly treated later than their ordering as a MultiIndex, next state)
+    """
+    watermark = state["watermark"]
+    if (newRecords["Arrival Date"] <= watermark).any():
+        raise ValueError("New records must arrive after the watermark {}".format(watermark))
+
+    waiting = state["waiting"]
+    combined = pd.concat([waiting, newRecords], ignore_index=True)
+    isNew = pd.Series([False] * len(waiting) + [True] * len(newRecords))
+    combined, timeline = transformDataset(combined, triageTimeLimit)
+    isNew = isNew.loc[combined.index].to_numpy()
+
+    # snapshots of waiting patients' arrivals are already in the stored timeline
+    deltaTimeline = timeline.loc[isNew[timeline["Snapshot"].to_numpy()]].reset_index(drop=True)
+    deltaDataset = combined.loc[isNew].reset_index(drop=True)
+
+    # waiting patients can only be newly ranked out of order in snapshots after the watermark
+    newlyLate = flagTimelineIndex(combined, deltaTimeline).to_numpy()[~isNew]
+    newlyLate &= waiting["TreatedLaterThanOrdering"].to_numpy() != 1
+    reflagged = pd.MultiIndex.from_arrays([waiting.loc[newlyLate, "MRN"], waiting.loc[newlyLate, "Presentation Visit Number"]])
+
+    # combined positions -> stored positions, waiting patients first then the new rows appended after the stored rows
+    storedPositions = np.concatenate([state["positions"], state["rows"] + np.arange(len(deltaDataset))]).astype(deltaTimeline["Snapshot"].dtype)
+    deltaTimeline["Snapshot"] = storedPositions[deltaTimeline["Snapshot"].to_numpy()]
+    deltaTimeline["Patient"] = storedPositions[deltaTimeline["Patient"].to_numpy()]
+
+    waiting = waiting.copy()
+    waiting.loc[newlyLate, "TreatedLaterThanOrdering"] = True
+    nextWatermark = max(watermark, deltaDataset["Arrival Date"].max()) if len(deltaDataset) > 0 else watermark
+    candidates = pd.concat([waiting, deltaDataset], ignore_index=True)
+    stillWaiting = np.flatnonzero((candidates["Dr Seen Date"] > nextWatermark).to_numpy())
+    nextState = {"watermark": pd.Timestamp(nextWatermark), "waiting": candidates.iloc[stillWaiting].reset_index(drop=True),
+                 "positions": storedPositions[stillWaiting].astype("int64"), "rows": state["rows"] + len(deltaDataset)}
+
+    return deltaDataset, deltaTimeline, reflagged, nextState
+
+def applyIncrement(Dataset_ED, CurrentPresentationsDf, deltaDataset, deltaTimeline, reflagged):
+    """Combine the stored transformed dataset and timeline index with an increment from transformIncrement.
+
+    Input:
+        Dataset_ED - stored transformed dataset
+        CurrentPresentationsDf - stored ED wait room timeline index
+        deltaDataset - transformed new rows
+        deltaTimeline - new timeline index rows
+        reflagged - MultiIndex of (MRN, Presentation Visit Number) newly treated later than their ordering
+
+    Output:
+        Tuple of (transformed dataset, ED wait room timeline index) as a full recompute would produce them
+    """
+    presentations = pd.MultiIndex.from_arrays([Dataset_ED["MRN"], Dataset_ED["Presentation Visit Number"]])
+    Dataset_ED = Dataset_ED.copy()
+    Dataset_ED.loc[presentations.isin(reflagged), "TreatedLaterThanOrdering"] = True
+
+    return pd.concat([Dataset_ED, deltaDataset], ignore_index=True), pd.concat([CurrentPresentationsDf, deltaTimeline], ignore_index=True)
+
+def saveState(state, storeDir, key):
+    """Persist incremental state next to the stored tables under key.
+    """
+    saveTables({STATE_TABLE: state["waiting"]}, storeDir, key)
+    with open(os.path.join(storeDir, key, "watermark.json"), "w") as watermarkFile:
+        json.dump({"version": STATE_VERSION, "watermark": state["watermark"].isoformat(), "rows": int(state["rows"]), "positions": [int(position) for position in state["positions"]]}, watermarkFile)
+
+    return
+
+def loadState(storeDir, key):
+    """Load incremental state stored under key, or None if there is none or it was written by an earlier version.
+    """
+    watermarkPath = os.path.join(storeDir, key, "watermark.json")
+    tables = loadTables([STATE_TABLE], storeDir, key)
+    if tables is None or not os.path.exists(watermarkPath):
+        return None
+    with open(watermarkPath) as watermarkFile:
+        saved = json.load(watermarkFile)
+    if saved.get("version") != STATE_VERSION:
+        return None
+
+    return {"watermark": pd.Timestamp(saved["watermark"]), "waiting": tables[STATE_TABLE], "positions": np.asarray(saved["positions"], dtype="int64"), "rows": saved["rows"]}
+
+def loadIncremental(storeDir, key, storeFormat="parquet"):
+    """Load the transformed dataset and timeline index of an incremental store, with the rows reflagged by later appends applied.
+
+    Output:
+        Tuple of (transformed dataset, ED wait room timeline index) as a full recompute would produce them, or None if the store is empty
+    """
+    tables = loadTables([DATASET_TABLE, TIMELINE_TABLE, REFLAGGED_TABLE], storeDir, key, storeFormat)
+    if tables is None:
+        return None
+    Dataset_ED = tables[DATASET_TABLE]
+    Dataset_ED.loc[tables[REFLAGGED_TABLE]["Position"].to_numpy(), "TreatedLaterThanOrdering"] = True
+
+    return Dataset_ED, tables[TIMELINE_TABLE]
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 26/04/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module indexes presentation intervals (arrival to Dr seen, arrival to departure) to answer "who was waiting / in ED at t",
+          "who was present between t1 and t2" and "what was occupancy by triage" without masking the whole dataset for every question.
+          Interval starts and ends are kept sorted per triage priority with prefix sums, so counts at a time or over a range take two binary searches,
+          and time weighted occupancy over any bin comes from the prefix sums. Listing the patients present uses the same binary searches on intervals
+          grouped by duration class, so only intervals long enough to still be open are checked.
+          Indexes are saved as a directory of .npy files next to the transformed dataset and are memory mapped when loaded.
+          An index can also be stored as parts, one per batch of appended rows, which queries combine, so appending never rebuilds earlier parts.
+          A patient is present at t when start < t and end > t, and between t1 and t2 when start < t2 and end > t1, as in Occupancy.countOpenIntervals.
+"""
+
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from Occupancy import toEpoch
+
+# interval kind to (start column, end column)
+INTERVALS = {"waiting": ("Arrival Date", "Dr Seen Date"), "in ED": ("Arrival Date", "Depart Actual Date")}
+INTERVAL_INDEX = "Interval Index"
+NANOSECONDS_PER_MINUTE = 60 * 10**9
+# interval durations are grouped into classes of [2^k, 2^(k+1)) minutes for listing queries
+DURATION_CLASSES = 24
+
+def _epochs(times):
+    """int64 epoch nanoseconds of a time or array of times.
+    """
+    return pd.DatetimeIndex(pd.to_datetime(np.atleast_1d(times))).as_unit("ns").asi8
+
+def buildIntervalIndex(dataset, intervals=INTERVALS, groupColumn="Triage Priority", offset=0):
+    """Index the presentation intervals of dataset.
+
+    Input:
+        dataset - transformed dataset, query results are row positions into it
+        intervals - dictionary of interval kind to (start column, end column)
+        groupColumn - column occupancy is broken down by, rows with a missing value only count towards totals
+        offset - row position of the first row of dataset, for an index of rows appended to a stored dataset
+
+    Output:
+        Dictionary holding origin (epoch nanoseconds all minute offsets are relative to), groups (values of groupColumn),
+        groupColumn, rows (number of rows of dataset), offset and, per interval kind, the sorted arrays answering queries
+    """
+    groupValues = dataset[groupColumn]
+    groups = np.sort(pd.unique(groupValues.dropna().to_numpy()))
+    codes = np.where(groupValues.isna().to_numpy(), len(groups), np.searchsorted(groups, groupValues.fillna(groups[0] if len(groups) else 0).to_numpy()))
+
+    columns = {kind: [toEpoch(dataset[column]) for column in pair] for kind, pair in intervals.items()}
+    starts = [times[~missing] for (times, missing), _ in columns.values() if (~missing).any()]
+    origin = int(min(start.min() for start in starts)) if starts else 0
+
+    index = {"origin": origin, "groups": groups, "groupColumn": groupColumn, "rows": len(dataset), "offset": offset, "kinds": {}}
+    for kind, ((startTimes, startNaT), (endTimes, endNaT)) in columns.items():
+        # intervals with a missing or non positive length are never present
+        rows = np.flatnonzero(~(startNaT | endNaT) & (endTimes > startTimes))
+        entry = {"columns": list(intervals[kind])}
+
+        # starts and ends sorted by (group, time), group g occupying [groupOffsets[g], groupOffsets[g + 1])
+        for name, times in (("starts", startTimes[rows]), ("ends", endTimes[rows])):
+            order = np.lexsort((times, codes[rows]))
+            entry[name] = times[order]
+            # minutes since origin summed up to each position, with a leading zero
+            entry[name[:-1] + "Sums"] = np.concatenate([[0.0], np.cumsum((times[order] - origin) / NANOSECONDS_PER_MINUTE)])
+        entry["groupOffsets"] = np.searchsorted(np.sort(codes[rows]), np.arange(len(groups) + 2))
+
+        # rows sorted by (duration class, start), class k occupying [classOffsets[k], classOffsets[k + 1]) with its longest duration in classDurations[k]
+        durations = endTimes[rows] - startTimes[rows]
+        classes = np.clip(np.floor(np.log2(np.maximum(durations / NANOSECONDS_PER_MINUTE, 1))).astype("int64"), 0, DURATION_CLASSES - 1)
+        order = np.lexsort((startTimes[rows], classes))
+        entry["classRows"] = offset + rows[order]
+        entry["classStarts"] = startTimes[rows][order]
+        entry["classEnds"] = endTimes[rows][order]
+        entry["classOffsets"] = np.searchsorted(classes[order], np.arange(DURATION_CLASSES + 1))
+        entry["classDurations"] = np.array([durations[classes == k].max() if (classes == k).any() else 0 for k in range(DURATION_CLASSES)], dtype="int64")
+        index["kinds"][kind] = entry
+
+    return index
+
+def _parts(index):
+    """Indexes of the parts of an index, or the index itself if it has none.
+    """
+    return index.get("parts", [index])
+
+def _groupSums(index, kind, values):
+    """Sum per group arrays over the parts of an index.
+
+    Input:
+        index - interval index
+        kind - interval kind e.g. "waiting" or "in ED"
+        values - function of (part, entry of kind in part, group code in part) giving the array of one group of a part
+
+    Output:
+        Array with a row per value of index["groups"] and a last row for the missing group
+    """
+    sums = None
+    for part in _parts(index):
+        targets = np.append(np.searchsorted(index["groups"], part["groups"]), len(index["groups"]))
+        for group, target in enumerate(targets):
+            groupValues = values(part, part["kinds"][kind], group)
+            if sums is None:
+                sums = np.zeros((len(index["groups"]) + 1,) + np.shape(groupValues))
+            sums[target] += groupValues
+
+    return sums
+
+def presentBetween(index, kind, start, end=None):
+    """Row positions of patients present at any time between start and end, or at start if end is None.
+
+    Input:
+        index - interval index from buildIntervalIndex or loadIntervalIndex
+        kind - interval kind e.g. "waiting" or "in ED"
+        start - time, anything pandas.to_datetime accepts
+        end - time, defaults to start
+
+    Output:
+        Sorted int64 numpy array of row positions
+    """
+    queryStart = _epochs(start)[0]
+    queryEnd = queryStart if end is None else _epochs(end)[0]
+
+    positions = []
+    for part in _parts(index):
+        entry = part["kinds"][kind]
+        for k in range(DURATION_CLASSES):
+            lower, upper = entry["classOffsets"][k], entry["classOffsets"][k + 1]
+            if lower == upper:
+                continue
+            # an interval of the class starting at or before queryStart - its longest duration has ended by queryStart
+            classStarts = entry["classStarts"][lower:upper]
+            first = lower + np.searchsorted(classStarts, queryStart - entry["classDurations"][k], side="right")
+            last = lower + np.searchsorted(classStarts, queryEnd, side="left")
+            candidates = np.arange(first, last)
+            positions.append(entry["classRows"][candidates[entry["classEnds"][candidates] > queryStart]])
+
+    return np.sort(np.concatenate(positions)) if positions else np.array([], dtype="int64")
+
+def presentAt(index, kind, time):
+    """Row positions of patients present at time. See presentBetween.
+    """
+    return presentBetween(index, kind, time)
+
+def _started(entry, group, times, side):
+    """Number of intervals of a group started before times and the sum of their starts in minutes since origin.
+    """
+    lower, upper = entry["groupOffsets"][group], entry["groupOffsets"][group + 1]
+    counts = np.searchsorted(entry["starts"][lower:upper], times, side=side)
+
+    return counts, entry["startSums"][lower + counts] - entry["startSums"][lower]
+
+def _ended(entry, group, times, side):
+    """Number of intervals of a group ended by times and the sum of their ends in minutes since origin.
+    """
+    lower, upper = entry["groupOffsets"][group], entry["groupOffsets"][group + 1]
+    counts = np.searchsorted(entry["ends"][lower:upper], times, side=side)
+
+    return counts, entry["endSums"][lower + counts] - entry["endSums"][lower]
+
+def _byGroup(index, values):
+    """DataFrame of per group arrays with a Total column, the missing group only counted in the total.
+    """
+    table = pd.DataFrame({group: values[code] for code, group in enumerate(index["groups"].tolist())})
+    table["Total"] = np.sum(values, axis=0)
+
+    return table
+
+def occupancyAt(index, kind, times):
+    """Number of patients present at each time, by group.
+
+    Input:
+        index - interval index
+        kind - interval kind e.g. "waiting" or "in ED"
+        times - array of times
+
+    Output:
+        DataFrame indexed by times with a column per group and a Total column
+    """
+    queryTimes = _epochs(times)
+    counts = _groupSums(index, kind, lambda part, entry, group: _started(entry, group, queryTimes, "left")[0] - _ended(entry, group, queryTimes, "right")[0]).astype("int64")
+
+    return _byGroup(index, counts).set_index(pd.DatetimeIndex(queryTimes.view("datetime64[ns]"), name="Datetime"))
+
+def countPresent(index, kind, start, end=None):
+    """Number of patients present at any time between start and end, or at start if end is None, by group.
+
+    Output:
+        pandas Series with an entry per group and a Total entry
+    """
+    queryStart = _epochs(start)
+    queryEnd = queryStart if end is None else _epochs(end)
+    counts = _groupSums(index, kind, lambda part, entry, group: _started(entry, group, queryEnd, "left")[0] - _ended(entry, group, queryStart, "right")[0]).astype("int64")
+
+    return pd.Series(np.append(counts[:-1, 0], counts[:, 0].sum()), index=index["groups"].tolist() + ["Total"], name=kind)
+
+def occupancyCurve(index, kind, start, end, freq="1h", how="mean"):
+    """Occupancy between start and end at any resolution.
+
+    Input:
+        index - interval index
+        kind - interval kind e.g. "waiting" or "in ED"
+        start, end - times bounding the curve
+        freq - pandas frequency of the bins e.g. "1min", "1h", "1D"
+        how - "mean" for the time weighted mean number of patients present over each bin, "point" for the number present at each bin start
+
+    Output:
+        DataFrame indexed by bin start with a column per group and a Total column
+    """
+    edges = pd.date_range(pd.Timestamp(start), pd.Timestamp(end), freq=freq)
+    if how == "point":
+        return occupancyAt(index, kind, edges)
+    if how != "mean":
+        raise ValueError("Unknown occupancy curve {}, expected mean or point".format(how))
+
+    edges = edges.append(pd.DatetimeIndex([edges[-1] + pd.tseries.frequencies.to_offset(freq)])) if len(edges) else edges
+    edgeTimes = _epochs(edges)
+
+    def area(part, entry, group):
+        # minutes of presence up to x: sum over started intervals of (x - start) less sum over ended intervals of (x - end)
+        edgeMinutes = (edgeTimes - part["origin"]) / NANOSECONDS_PER_MINUTE
+        startedCounts, startedSums = _started(entry, group, edgeTimes, "left")
+        endedCounts, endedSums = _ended(entry, group, edgeTimes, "left")
+
+        return edgeMinutes * (startedCounts - endedCounts) - startedSums + endedSums
+
+    means = np.diff(_groupSums(index, kind, area), axis=1) / (np.diff(edgeTimes) / NANOSECONDS_PER_MINUTE)
+
+    return _byGroup(index, means).set_index(pd.DatetimeIndex(edges[:-1], name="Datetime"))
+
+def _writeIndex(index, path):
+    """Write an interval index to a directory as .npy files and a JSON description. The directory is replaced as a whole.
+    """
+    os.makedirs(path + ".tmp", exist_ok=True)
+    description = {"origin": index["origin"], "groups": index["groups"].tolist(), "groupColumn": index["groupColumn"], "rows": index["rows"], "offset": index["offset"],
+                   "kinds": {kind: entry["columns"] for kind, entry in index["kinds"].items()}}
+    for number, (kind, entry) in enumerate(index["kinds"].items()):
+        for name, values in entry.items():
+            if name != "columns":
+                np.save(os.path.join(path + ".tmp", "{}-{}.npy".format(number, name)), values)
+    with open(os.path.join(path + ".tmp", "index.json"), "w") as descriptionFile:
+        json.dump(description, descriptionFile)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(path + ".tmp", path)
+
+    return
+
+def _readIndex(path):
+    """Read an interval index written by _writeIndex with its arrays memory mapped.
+    """
+    with open(os.path.join(path, "index.json")) as descriptionFile:
+        description = json.load(descriptionFile)
+
+    index = {"origin": description["origin"], "groups": np.asarray(description["groups"]), "groupColumn": description["groupColumn"], "rows": description["rows"],
+             "offset": description.get("offset", 0), "kinds": {}}
+    for number, (kind, columns) in enumerate(description["kinds"].items()):
+        entry = {"columns": columns}
+        for name in os.listdir(path):
+            if name.startswith("{}-".format(number)) and name.endswith(".npy"):
+                entry[name[len("{}-".format(number)):-len(".npy")]] = np.load(os.path.join(path, name), mmap_mode="r")
+        index["kinds"][kind] = entry
+
+    return index
+
+def saveIntervalIndex(index, storeDir, key):
+    """Write an interval index to the store under key as .npy files and a JSON description. The directory is replaced as a whole.
+    """
+    _writeIndex(index, os.path.join(storeDir, key, INTERVAL_INDEX))
+
+    return
+
+def appendIntervalIndex(index, storeDir, key):
+    """Store the interval index of appended rows as the next part of the index stored under key, see buildIntervalIndex's offset.
+    """
+    path = os.path.join(storeDir, key, INTERVAL_INDEX)
+    os.makedirs(path, exist_ok=True)
+    part = len([name for name in os.listdir(path) if name.startswith("part-") and not name.endswith(".tmp")])
+    _writeIndex(index, os.path.join(path, "part-{:05d}".format(part)))
+
+    return
+
+def loadIntervalIndex(storeDir, key):
+    """Load an interval index stored under key with its arrays memory mapped, or None if there is none.
+    An index stored as parts is loaded as the parts and their combined origin, groups and rows, which every query accepts.
+    """
+    path = os.path.join(storeDir, key, INTERVAL_INDEX)
+    if os.path.exists(os.path.join(path, "index.json")):
+        return _readIndex(path)
+    names = sorted(name for name in os.listdir(path) if name.startswith("part-") and not name.endswith(".tmp")) if os.path.isdir(path) else []
+    if not names:
+        return None
+
+    parts = [_readIndex(os.path.join(path, name)) for name in names]
+    groups = np.sort(pd.unique(np.concatenate([part["groups"] for part in parts if len(part["groups"])] or [parts[0]["groups"]])))
+
+    return {"origin": min(part["origin"] for part in parts), "groups": groups, "groupColumn": parts[0]["groupColumn"], "rows": sum(part["rows"] for part in parts),
+            "offset": 0, "parts": parts}
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 16/04/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module runs the Transformation stages on datasets covering several sites and years by splitting them into site x time window
+          partitions and transforming the partitions in a process pool. Each partition carries the patients of its site who arrived before
+          the window but were still waiting at its start, so occupancy counts and timeline snapshots near window boundaries are complete.
+          Results are stitched back in a fixed order, so they do not depend on the window length or the number of processes.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from Occupancy import toEpoch
+from Timeline import flagTimelineIndex
+from Profiling import RunReport
+
+SITE_COLUMN = "Site"
+
+def partitionDataset(dataset, siteColumn=SITE_COLUMN, window="90D"):
+    """Split dataset into site x time window partitions.
+
+    A patient belongs to the window of their Arrival Date, and is carried into every later window of their site that starts
+    before their Dr Seen Date. Rows without an Arrival Date belong to the first window of their site.
+
+    Input:
+        dataset - Generic ED 2009 dataset
+        siteColumn - column identifying the site, the whole dataset is one site if it is missing
+        window - pandas timedelta string or Timedelta for the length of each window
+
+    Output:
+        List of dictionaries with site, start (window start as epoch nanoseconds), positions (sorted row positions of the partition)
+        and core (boolean mask over positions of the rows belonging to the window), in site then window order
+    """
+    arrivalTimes, arrivalNaT = toEpoch(dataset["Arrival Date"])
+    seenTimes, seenNaT = toEpoch(dataset["Dr Seen Date"])
+    if len(dataset) == 0:
+        return []
+    if arrivalNaT.all():
+        return [{"site": None, "start": None, "positions": np.arange(len(dataset)), "core": np.ones(len(dataset), dtype=bool)}]
+
+    step = pd.Timedelta(window).value
+    first = arrivalTimes[~arrivalNaT].min()
+    arrivalWindow = np.where(arrivalNaT, 0, (arrivalTimes - first) // step)
+
+    # a patient is carried into windows k > arrivalWindow with start(k) < Dr Seen Date
+    carried = ~(arrivalNaT | seenNaT) & (seenTimes > arrivalTimes)
+    lastWindow = np.where(carried, -(-(seenTimes - first) // step) - 1, arrivalWindow)
+    spans = np.maximum(lastWindow - arrivalWindow, 0)
+    contextPositions = np.repeat(np.arange(len(dataset)), spans)
+    offsets = np.arange(len(contextPositions)) - np.repeat(np.cumsum(spans) - spans, spans)
+    contextWindows = np.repeat(arrivalWindow, spans) + offsets + 1
+
+    if siteColumn in dataset.columns:
+        siteCodes, sites = pd.factorize(dataset[siteColumn], sort=True)
+    else:
+        siteCodes, sites = np.zeros(len(dataset), dtype="int64"), [None]
+
+    # order rows and carried rows by (site, window, row position) and cut the runs into partitions
+    positions = np.concatenate([np.arange(len(dataset)), contextPositions])
+    windows = np.concatenate([arrivalWindow, contextWindows])
+    core = np.concatenate([np.ones(len(dataset), dtype=bool), np.zeros(len(contextPositions), dtype=bool)])
+    codes = siteCodes[positions]
+    order = np.lexsort((positions, windows, codes))
+    positions, windows, core, codes = positions[order], windows[order], core[order], codes[order]
+
+    boundaries = np.flatnonzero((np.diff(codes) != 0) | (np.diff(windows) != 0)) + 1
+    partitions = []
+    for run in np.split(np.arange(len(positions)), boundaries):
+        # windows holding only carried patients have nothing to transform
+        if not core[run].any():
+            continue
+        code = codes[run[0]]
+        partitions.append({"site": sites[code] if code >= 0 else None, "start": first + windows[run[0]] * step, "positions": positions[run], "core": core[run]})
+
+    return partitions
+
+def _transformPartition(task):
+    """Transform one partition and keep the rows and snapshots of its window, with timeline positions mapped to the whole dataset.
+    """
+    partition, positions, core, triageTimeLimit, transformDataset = task
+    Dataset_ED, CurrentPresentationsDf = transformDataset(partition, triageTimeLimit)
+    Dataset_ED = Dataset_ED.iloc[np.flatnonzero(core)]
+    # carried patients arrived before the window, their own snapshots belong to an earlier partition
+    CurrentPresentationsDf = CurrentPresentationsDf.loc[core[CurrentPresentationsDf["Snapshot"].to_numpy()]].copy()
+    for column in ("Snapshot", "Patient"):
+        CurrentPresentationsDf[column] = positions[CurrentPresentationsDf[column].to_numpy()].astype(CurrentPresentationsDf[column].dtype)
+
+    return Dataset_ED, CurrentPresentationsDf
+
+def transformPartitioned(Dataset_ED, triageTimeLimit, transformDataset, siteColumn=SITE_COLUMN, window="90D", processes=None, report=None):
+    """Clean and transform the dataset partition by partition.
+
+    Snapshots are ranked within their site. For a single site dataset the result equals transformDataset's.
+    TreatedLaterThanOrdering is flagged on the stitched timeline, as a patient waiting across a window boundary appears in snapshots of both windows.
+
+    Input:
+        Dataset_ED - Generic ED 2009 dataset
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+        transformDataset - Transformation.transformDataset, applied to every partition
+        siteColumn - column identifying the site
+        window - pandas timedelta string or Timedelta for the length of each window
+        processes - number of worker processes. None transforms the partitions in the current process
+        report - RunReport the stages are recorded in, None records them in a throwaway report
+
+    Output:
+        Tuple of (transformed dataset in row order, ED wait room timeline index ordered by snapshot row then patient row)
+    """
+    report = report or RunReport("transformPartitioned")
+
+    # drop unwanted data i.e. patients for deletion, before carried patients are chosen
+    Dataset_ED = Dataset_ED.loc[~Dataset_ED["Depart Status Code"].isin(["ZZ", "D"])]
+
+    partitions = report.run("partition", partitionDataset, Dataset_ED, siteColumn, window, rowsIn=len(Dataset_ED))
+    tasks = [(Dataset_ED.iloc[partition["positions"]].copy(), partition["positions"], partition["core"], triageTimeLimit, transformDataset) for partition in partitions]
+
+    with report.stage("transform partitions", rowsIn=sum(len(task[0]) for task in tasks)) as record:
+        if processes is None or len(tasks) < 2:
+            results = [_transformPartition(task) for task in tasks]
+        else:
+            # map returns results in task order whichever worker finishes first
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                results = list(executor.map(_transformPartition, tasks))
+        record["rows out"] = sum(len(result[0]) for result in results)
+
+    with report.stage("stitch", rowsIn=sum(len(result[1]) for result in results)) as record:
+        corePositions = np.concatenate([partition["positions"][partition["core"]] for partition in partitions])
+        transformed = pd.concat([result[0] for result in results])
+        transformed = transformed.iloc[np.argsort(corePositions, kind="stable")]
+        CurrentPresentationsDf = pd.concat([result[1] for result in results], ignore_index=True)
+        order = np.lexsort((CurrentPresentationsDf["Patient"].to_numpy(), CurrentPresentationsDf["Snapshot"].to_numpy()))
+        CurrentPresentationsDf = CurrentPresentationsDf.iloc[order].reset_index(drop=True)
+        record["rows out"] = len(CurrentPresentationsDf)
+
+    transformed["TreatedLaterThanOrdering"] = report.run("treated later flag", flagTimelineIndex, transformed, CurrentPresentationsDf, rowsIn=len(CurrentPresentationsDf))
+
+    return transformed, CurrentPresentationsDf
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 15/04/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module instruments the named stages of Transformation.py, Analysis.py and PopulationAnalysis.py.
+          Each stage records wall time, CPU time (including worker processes), peak RSS growth and rows in and out, optionally under cProfile,
+          and a run writes all stages to a JSON run report so regressions can be tracked per stage rather than per job.
+          Scripts accept --report <path> to choose the report file and --profile to write a cProfile dump per stage.
+"""
+
+import cProfile
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # resource is not available on Windows, RSS and worker CPU time are then not recorded
+    resource = None
+
+REPORT_DIR = "reports"
+PROFILE_DIR = "profiles"
+
+def peakRSS():
+    """Peak resident set size of this process in MB, None where it cannot be measured.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+def childCPU():
+    """CPU seconds used by terminated worker processes of this process.
+    """
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return usage.ru_utime + usage.ru_stime
+
+def countRows(value):
+    """Number of rows of a stage's output: the length of a DataFrame, Series or array, or of the first such item of a tuple.
+    """
+    if isinstance(value, tuple):
+        value = next((item for item in value if hasattr(item, "__len__") and not isinstance(item, (str, dict))), None)
+    if value is None or not hasattr(value, "__len__") or isinstance(value, (str, dict)):
+        return None
+
+    return len(value)
+
+class RunReport:
+    """Per stage measurements of one run of a script.
+
+    Input:
+        script - name of the script, used to name the report and profile files
+        profile - whether to run each stage under cProfile
+        profileDir - directory cProfile dumps are written to
+    """
+
+    def __init__(self, script, profile=False, profileDir=PROFILE_DIR):
+        self.script = script
+        self.profile = profile
+        self.profileDir = profileDir
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, rowsIn=None):
+        """Measure the enclosed block as a named stage. The yielded record's "rows out" can be set inside the block.
+        """
+        record = {"stage": name, "rows in": rowsIn, "rows out": None}
+        profiler = cProfile.Profile() if self.profile else None
+        rssBefore = peakRSS()
+        childBefore = childCPU()
+        cpuBefore = time.process_time()
+        wallBefore = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record["wall seconds"] = time.perf_counter() - wallBefore
+            record["cpu seconds"] = time.process_time() - cpuBefore + childCPU() - childBefore
+            rssAfter = peakRSS()
+            record["peak RSS delta (MB)"] = None if rssBefore is None else rssAfter - rssBefore
+            if profiler is not None:
+                os.makedirs(self.profileDir, exist_ok=True)
+                record["profile"] = os.path.join(self.profileDir, "{}-{}.prof".format(self.script, name.replace(" ", "_")))
+                profiler.dump_stats(record["profile"])
+            self.stages.append(record)
+
+    def run(self, name, function, *args, rowsIn=None, **kwargs):
+        """Run function as a named stage, counting the rows of its return value.
+
+        Output:
+            Return value of function
+        """
+        with self.stage(name, rowsIn=rowsIn) as record:
+            value = function(*args, **kwargs)
+            record["rows out"] = countRows(value)
+
+        return value
+
+    def summary(self):
+        """Run report as a dictionary.
+        """
+        return {
+            "script": self.script,
+            "started": self.started,
+            "wall seconds": sum(record["wall seconds"] for record in self.stages),
+            "cpu seconds": sum(record["cpu seconds"] for record in self.stages),
+            "peak RSS (MB)": peakRSS(),
+            "stages": self.stages,
+        }
+
+    def write(self, path=None):
+        """Write the run report as JSON, by default to reports/<script>.json.
+
+        Output:
+            Path of the report
+        """
+        path = path or os.path.join(REPORT_DIR, self.script + ".json")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as reportFile:
+            json.dump(self.summary(), reportFile, indent=1)
+
+        return path
+
+def reportFromArguments(script, argv=None):
+    """Create a RunReport configured from the command line flags --profile and --report <path>.
+
+    Output:
+        Tuple of (RunReport, report path or None for the default path)
+    """
+    argv = sys.argv if argv is None else argv
+    path = argv[argv.index("--report") + 1] if "--report" in argv else None
+
+    return RunReport(script, profile="--profile" in argv), path
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 22/04/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module compares LateSeenByDr between TreatedLaterThanOrdering groups with resampling instead of normality-gated tests:
+          bootstrap confidence intervals for the difference in medians and in mean ranks, and permutation p-values for both.
+          Resamples are drawn in batches as count matrices over the distinct values of LateSeenByDr, one row per resample, either by multinomial
+          and hypergeometric draws when values repeat (minute resolution data) or from index matrices otherwise. Batches are sized to bound memory
+          and can be spread across a process pool.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+VALUE_COLUMN = "LateSeenByDr"
+GROUP_COLUMN = "TreatedLaterThanOrdering"
+RESULT_COLUMNS = ["statistic", "estimate", "ci lower", "ci upper", "standard error", "pvalue", "n 0", "n 1", "resamples"]
+# elements per batch of a count or index matrix, about 128 MB of int64
+MAX_ELEMENTS = 1 << 24
+
+def medianDifference(values, counts0, counts1):
+    """Median of group 1 minus median of group 0 for each row of count matrices over sorted distinct values.
+    """
+    return _median(values, counts1) - _median(values, counts0)
+
+def meanRankDifference(values, counts0, counts1):
+    """Mean rank of group 1 minus mean rank of group 0 in the pooled sample, ties given their average rank, for each row of count matrices.
+    Equals N * (P(group 1 > group 0) + P(tie) / 2 - 1/2) for N pooled observations.
+    """
+    pooled = counts0 + counts1
+    midRanks = np.cumsum(pooled, axis=1) - (pooled - 1) / 2.0
+
+    return (counts1 * midRanks).sum(axis=1) / counts1.sum(axis=1) - (counts0 * midRanks).sum(axis=1) / counts0.sum(axis=1)
+
+def _median(values, counts):
+    cumulative = np.cumsum(counts, axis=1)
+    n = cumulative[:, -1:]
+    lower = (cumulative > (n - 1) // 2).argmax(axis=1)
+    upper = (cumulative > n // 2).argmax(axis=1)
+
+    return (values[lower] + values[upper]) / 2.0
+
+STATISTICS = {"median": medianDifference, "meanrank": meanRankDifference}
+
+def _indexCounts(codes, draws, categories):
+    """Count matrix of codes[draws] for an index matrix draws, one row per resample.
+    """
+    rows = draws.shape[0]
+    offsets = np.arange(rows)[:, np.newaxis] * categories
+
+    return np.bincount((codes[draws] + offsets).ravel(), minlength=rows * categories).reshape(rows, categories)
+
+def _resampleBatch(task):
+    """Draw one batch of bootstrap or permutation resamples and evaluate the statistics on it.
+    """
+    kind, values, codes0, codes1, counts0, counts1, statistics, size, seed = task
+    rng = np.random.default_rng(seed)
+    categories = len(values)
+    n0, n1 = len(codes0), len(codes1)
+    # multinomial and hypergeometric draws cost per distinct value, index matrices per observation
+    byCounts = categories * 8 < n0 + n1
+
+    if kind == "bootstrap":
+        if byCounts:
+            draws0 = rng.multinomial(n0, counts0 / n0, size=size)
+            draws1 = rng.multinomial(n1, counts1 / n1, size=size)
+        else:
+            draws0 = _indexCounts(codes0, rng.integers(0, n0, (size, n0)), categories)
+            draws1 = _indexCounts(codes1, rng.integers(0, n1, (size, n1)), categories)
+    else:
+        pooled = counts0 + counts1
+        if byCounts:
+            draws1 = rng.multivariate_hypergeometric(pooled, n1, size=size)
+        else:
+            labels = np.tile(np.arange(n0 + n1), (size, 1))
+            draws1 = _indexCounts(np.concatenate([codes0, codes1]), rng.permuted(labels, axis=1)[:, :n1], categories)
+        draws0 = pooled - draws1
+
+    return {name: STATISTICS[name](values, draws0, draws1) for name in statistics}
+
+def _batches(resamples, width, maxElements):
+    size = max(1, min(resamples, maxElements // max(width, 1)))
+
+    return [min(size, resamples - start) for start in range(0, resamples, size)]
+
+def compareGroups(values, groups, statistics=tuple(STATISTICS), resamples=10000, confidence=0.95, seed=0, processes=None, maxElements=MAX_ELEMENTS):
+    """Bootstrap confidence intervals and permutation p-values for differences between two groups.
+
+    Input:
+        values - numpy array of observations, NaN are left out
+        groups - boolean numpy array, True for group 1
+        statistics - names of STATISTICS to evaluate, each is group 1 minus group 0
+        resamples - number of bootstrap and of permutation resamples
+        confidence - confidence level of the percentile bootstrap intervals
+        seed - seed of the random streams, batches get independent streams so results do not depend on processes
+        processes - number of worker processes. None runs in the current process
+        maxElements - bound on the elements of a batch's count or index matrix
+
+    Output:
+        DataFrame of RESULT_COLUMNS, one row per statistic. The permutation p-value is two-sided
+    """
+    values = np.asarray(values, dtype="float64")
+    groups = np.asarray(groups, dtype=bool)
+    present = ~np.isnan(values)
+    values, groups = values[present], groups[present]
+    n0, n1 = int((~groups).sum()), int(groups.sum())
+    if n0 == 0 or n1 == 0:
+        return pd.DataFrame([{"statistic": name, "estimate": np.nan, "ci lower": np.nan, "ci upper": np.nan, "standard error": np.nan,
+                              "pvalue": np.nan, "n 0": n0, "n 1": n1, "resamples": 0} for name in statistics], columns=RESULT_COLUMNS)
+
+    distinct, codes = np.unique(values, return_inverse=True)
+    codes0, codes1 = codes[~groups], codes[groups]
+    counts0 = np.bincount(codes0, minlength=len(distinct))
+    counts1 = np.bincount(codes1, minlength=len(distinct))
+    observed = {name: STATISTICS[name](distinct, counts0[np.newaxis, :], counts1[np.newaxis, :])[0] for name in statistics}
+
+    # the widest matrix of a batch is the count matrix or, without repeated values, the index matrix of the pooled sample
+    width = len(distinct) if len(distinct) * 8 < n0 + n1 else n0 + n1
+    sizes = _batches(resamples, width, maxElements)
+    seeds = np.random.SeedSequence(seed).spawn(2 * len(sizes))
+    tasks = [(kind, distinct, codes0, codes1, counts0, counts1, tuple(statistics), size, batchSeed)
+             for kind, kindSeeds in (("bootstrap", seeds[:len(sizes)]), ("permutation", seeds[len(sizes):])) for size, batchSeed in zip(sizes, kindSeeds)]
+
+    if processes is None or len(tasks) < 2:
+        results = [_resampleBatch(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(_resampleBatch, tasks))
+
+    alpha = (1 - confidence) / 2
+    rows = []
+    for name in statistics:
+        bootstrap = np.concatenate([result[name] for task, result in zip(tasks, results) if task[0] == "bootstrap"])
+        permutation = np.concatenate([result[name] for task, result in zip(tasks, results) if task[0] == "permutation"])
+        # permutation statistics are centred on the difference expected under exchangeability, 0 for both statistics
+        extreme = np.sum(np.abs(permutation) >= np.abs(observed[name]) - 1e-12)
+        rows.append({"statistic": name, "estimate": observed[name], "ci lower": np.quantile(bootstrap, alpha), "ci upper": np.quantile(bootstrap, 1 - alpha),
+                     "standard error": np.std(bootstrap, ddof=1), "pvalue": (extreme + 1) / (resamples + 1), "n 0": n0, "n 1": n1, "resamples": resamples})
+
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+def compareStrata(dataset, strataColumn=None, valueColumn=VALUE_COLUMN, groupColumn=GROUP_COLUMN, **options):
+    """Run compareGroups on the whole dataset and on every value of strataColumn e.g. per triage priority.
+
+    Input:
+        dataset - transformed dataset
+        strataColumn - column to stratify by, or None for the whole dataset only
+        valueColumn - column of observations
+        groupColumn - column of 0/1 group membership
+        options - keyword arguments of compareGroups
+
+    Output:
+        DataFrame with strataColumn ("All" for the whole dataset) and RESULT_COLUMNS
+    """
+    label = strataColumn or "stratum"
+    frames = [compareGroups(dataset[valueColumn].to_numpy(dtype="float64", na_value=np.nan), dataset[groupColumn].to_numpy() == 1, **options).assign(**{label: "All"})]
+    if strataColumn is not None:
+        for value, stratum in dataset.groupby(strataColumn, sort=True):
+            frames.append(compareGroups(stratum[valueColumn].to_numpy(dtype="float64", na_value=np.nan), stratum[groupColumn].to_numpy() == 1, **options).assign(**{label: value}))
+
+    results = pd.concat(frames, ignore_index=True)
+
+    return results[[label] + RESULT_COLUMNS]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 20/04/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module keeps the transformed dataset and ED wait room timeline index in compact dtypes: int8 triage priorities and calendar fields,
+          categorical status codes, int32 MRN and visit keys where they fit, int32 counts and bool flags.
+          Timestamps stay datetime64[ns], which is already an int64 epoch column. Columns missing from a dataset are skipped.
+"""
+
+import numpy as np
+import pandas as pd
+
+# column to compact dtype. Integer columns with missing values take the matching nullable dtype, flags with missing values take "boolean"
+DATASET_DTYPES = {
+    "MRN": "int32",
+    "Presentation Visit Number": "int32",
+    "Triage Priority": "int8",
+    "Depart Status Code": "category",
+    "Arrival Hour": "int8",
+    "Arrival Month": "int8",
+    "Arrival Day Of Week": "int8",
+    "TotalPatientsInEDWaitRoom": "int32",
+    "Triage 1 count": "int32",
+    "Triage 2 count": "int32",
+    "Triage 3 count": "int32",
+    "Triage 4 count": "int32",
+    "Triage 5 count": "int32",
+    "TotalPatientsInEDAtArrival": "int32",
+    "Check TreatDrNr-Act. Depart": "bool",
+    "Check Arrival-Actual Depart": "bool",
+    "LateFlag": "bool",
+    "TreatedLaterThanOrdering": "bool",
+}
+TIMELINE_INDEX_DTYPES = {"Snapshot": "int32", "Patient": "int32", "Actual Ranking": "int32", "Expected Ranking": "int32"}
+
+def _compactColumn(values, dtype):
+    """Convert one column, keeping it unchanged if its values do not fit dtype.
+    """
+    if dtype == "category":
+        return values.astype("category")
+
+    missing = values.isna()
+    if dtype == "bool":
+        return values.astype("boolean") if missing.any() else values.astype(bool)
+
+    numbers = pd.to_numeric(values, errors="coerce")
+    present = numbers[~missing]
+    info = np.iinfo(dtype)
+    # keys larger than the compact dtype and non integer values stay as they are
+    if numbers.isna().sum() > missing.sum() or (len(present) and (present.min() < info.min or present.max() > info.max or (present != np.floor(present)).any())):
+        return values
+
+    return numbers.astype(dtype.capitalize()) if missing.any() else numbers.astype(dtype)
+
+def compactDataset(dataset, dtypes=DATASET_DTYPES):
+    """Convert the columns of dataset named in dtypes to their compact dtype in place.
+
+    Output:
+        dataset
+    """
+    for column, dtype in dtypes.items():
+        if column in dataset.columns and str(dataset[column].dtype) != dtype:
+            dataset[column] = _compactColumn(dataset[column], dtype)
+
+    return dataset
+
+def compactTimeline(timelineIndex):
+    """Convert the columns of a timeline index to int32 in place.
+
+    Output:
+        timelineIndex
+    """
+    return compactDataset(timelineIndex, TIMELINE_INDEX_DTYPES)
+
+def memoryUsage(df):
+    """Memory held by a DataFrame including object and category contents, in MB.
+    """
+    return df.memory_usage(deep=True).sum() / 2**20
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 18/04/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module simulates the ED wait room under staffing what-if scenarios. Arrivals are replayed from the transformed dataset or
+          resampled by hour of week and triage mix, and are seen by a rostered number of doctors under a priority policy:
+            1. "strict" - lowest triage priority first, then arrival order
+            2. "fifo" - arrival order
+            3. "deadline" - earliest expected Dr seen time first
+          Replications run in lockstep as numpy arrays, one patient seen per replication per step, and batches of replications are spread
+          across a process pool. Each replication reports the lateness and out-of-order metrics of Transformation.py.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from Timeline import joinSnapshots, snapshotRanks
+
+HOURS_PER_WEEK = 168
+POLICIES = ("strict", "fifo", "deadline")
+# assumed mean minutes of doctor time per patient by triage priority, the dataset does not record consult length
+CONSULT_MINUTES = [60, 45, 35, 25, 20]
+CONSULT_SIGMA = 0.5
+# (snapshot, waiting patient) pairs joined at a time when flagging out of order patients
+SNAPSHOT_BLOCK_PAIRS = 1000000
+METRIC_COLUMNS = ["patients", "LateFlag", "LateSeenByDr median", "Wait mean (mins)", "Wait p90 (mins)", "TreatedLaterThanOrdering"]
+
+def weekStart(timestamp):
+    """Midnight of the Monday on or before timestamp, the origin of simulated time.
+    """
+    timestamp = pd.Timestamp(timestamp)
+
+    return timestamp.normalize() - pd.Timedelta(days=timestamp.dayofweek)
+
+def arrivalStream(dataset, levels=5):
+    """Extract the arrival stream of the transformed dataset.
+
+    Input:
+        dataset - transformed Generic ED 2009 dataset
+        levels - number of triage priorities, rows with other priorities are left out
+
+    Output:
+        Dictionary with origin (Monday midnight before the first arrival), minutes (float64 arrival minutes from origin, sorted)
+        and triage (int64 triage priorities)
+    """
+    triage = pd.to_numeric(dataset["Triage Priority"], errors="coerce")
+    valid = dataset["Arrival Date"].notna() & triage.between(1, levels)
+    arrivals = dataset.loc[valid, "Arrival Date"]
+    origin = weekStart(arrivals.min())
+    minutes = ((arrivals - origin) / pd.Timedelta(minutes=1)).to_numpy(dtype="float64")
+    order = np.argsort(minutes, kind="stable")
+
+    return {"origin": origin, "minutes": minutes[order], "triage": triage[valid].to_numpy(dtype="int64")[order]}
+
+def arrivalProfile(stream, levels=5):
+    """Mean arrivals per hour of week and the triage mix of each hour of week.
+
+    Output:
+        Tuple of (rate, mix) - float64 arrays of shape (168,) and (168, levels)
+    """
+    hours = (stream["minutes"] // 60).astype("int64")
+    weeks = max((hours.max() + 1) / HOURS_PER_WEEK, 1.0)
+    hourOfWeek = hours % HOURS_PER_WEEK
+    counts = np.zeros((HOURS_PER_WEEK, levels))
+    np.add.at(counts, (hourOfWeek, stream["triage"] - 1), 1)
+    totals = counts.sum(axis=1, keepdims=True)
+    # hours without history take the overall triage mix
+    overall = counts.sum(axis=0) / max(counts.sum(), 1)
+    mix = np.where(totals > 0, counts / np.maximum(totals, 1), overall)
+
+    return totals[:, 0] / weeks, mix
+
+def sampleArrivals(profile, days, rng):
+    """Sample an arrival stream from an hour of week profile: Poisson counts per hour, uniform minutes within the hour, triage from the hour's mix.
+
+    Input:
+        profile - (rate, mix) from arrivalProfile
+        days - number of days to sample, starting on a Monday
+        rng - numpy random Generator
+
+    Output:
+        Dictionary with minutes (sorted float64 arrival minutes) and triage (int64 triage priorities)
+    """
+    rate, mix = profile
+    hourOfWeek = np.arange(days * 24) % HOURS_PER_WEEK
+    counts = rng.poisson(rate[hourOfWeek])
+    hours = np.repeat(np.arange(days * 24), counts)
+    minutes = np.sort(hours * 60 + rng.random(len(hours)) * 60)
+    # triage by inverse cdf of the hour's mix
+    cdf = np.cumsum(mix, axis=1)[hourOfWeek[(minutes // 60).astype("int64")]]
+    triage = (rng.random(len(minutes))[:, np.newaxis] > cdf).sum(axis=1) + 1
+
+    return {"minutes": minutes, "triage": np.minimum(triage, mix.shape[1]).astype("int64")}
+
+def rosterTable(roster):
+    """Hours until each doctor is next on duty.
+
+    Input:
+        roster - number of doctors on duty for each hour of the day (24 values) or of the week from Monday (168 values)
+
+    Output:
+        float64 array of shape (doctors, 168), 0 where the doctor is on duty and inf where they never are
+    """
+    roster = np.asarray(roster, dtype="int64")
+    if len(roster) == 24:
+        roster = np.tile(roster, 7)
+    doctors = max(int(roster.max()), 1)
+    onDuty = np.arange(doctors)[:, np.newaxis] < roster[np.newaxis, :]
+
+    table = np.full((doctors, HOURS_PER_WEEK), np.inf)
+    # two passes backwards over the week carry the next shift across the week boundary
+    following = np.full(doctors, np.inf)
+    for hour in list(range(HOURS_PER_WEEK - 1, -1, -1)) * 2:
+        following = np.where(onDuty[:, hour], 0, following + 1)
+        table[:, hour] = following
+
+    return table
+
+def _nextOnDuty(table, minutes):
+    """Earliest minute at or after minutes at which each doctor is on duty. minutes has shape (replications, doctors).
+    """
+    finite = np.isfinite(minutes)
+    hours = np.floor(np.where(finite, minutes, 0) / 60)
+    wait = table[np.arange(table.shape[0])[np.newaxis, :], (hours % HOURS_PER_WEEK).astype("int64")]
+    ready = np.where(wait == 0, minutes, (hours + wait) * 60)
+
+    return np.where(finite, ready, np.inf)
+
+def _treatedLaterThanOrdering(arrival, expected, seen, blockPairs=SNAPSHOT_BLOCK_PAIRS):
+    """Flag patients ranked later by actual than by expected Dr seen time in a snapshot, ranked as rankTimeline ranks the ED wait room timeline.
+    arrival must be sorted. Snapshots are joined in blocks of about blockPairs (snapshot, waiting patient) pairs, as iterateTimeline
+    joins windows of snapshot time, so a long queue under a thin roster does not materialise the whole self-join.
+    """
+    # waiting patients at each snapshot, those arrived by then less those already seen
+    waiting = np.searchsorted(arrival, arrival, side="right") - np.searchsorted(np.sort(seen), arrival, side="right")
+    pairs = np.cumsum(waiting)
+    flagged = np.zeros(len(arrival), dtype=bool)
+
+    start = 0
+    while start < len(arrival):
+        # a block ends on a change of snapshot time, as repeated snapshots are ranked together
+        end = max(int(np.searchsorted(pairs, pairs[start] - waiting[start] + blockPairs, side="right")), start + 1)
+        end = int(np.searchsorted(arrival, arrival[end - 1], side="right"))
+        candidates = np.flatnonzero(seen[:end] > arrival[start])
+        queryPositions, patientPositions = joinSnapshots(arrival[start:end], arrival[candidates], seen[candidates])
+        snapshotTimes = arrival[start:end][queryPositions]
+        patientPositions = candidates[patientPositions]
+        late = snapshotRanks(snapshotTimes, seen[patientPositions]) > snapshotRanks(snapshotTimes, expected[patientPositions])
+        flagged[patientPositions[late]] = True
+        start = end
+
+    return flagged
+
+def simulateBatch(streams, roster, policy="strict", triageTimeLimit=(2, 10, 30, 60, 120), consultMinutes=CONSULT_MINUTES, consultSigma=CONSULT_SIGMA, rng=None, outOfOrder=True):
+    """Simulate a batch of replications in lockstep.
+
+    Input:
+        streams - list of arrival streams, one per replication, see arrivalStream and sampleArrivals
+        roster - number of doctors on duty by hour of day or hour of week, see rosterTable
+        policy - one of POLICIES
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+        consultMinutes - mean minutes of doctor time per patient by triage priority, consult times are log-normal
+        consultSigma - log-normal sigma of consult times
+        rng - numpy random Generator
+        outOfOrder - whether to compute the TreatedLaterThanOrdering share, which costs a snapshot join per replication
+
+    Output:
+        DataFrame of METRIC_COLUMNS and a LateFlag column per triage priority, one row per replication
+    """
+    if policy not in POLICIES:
+        raise ValueError("policy must be one of {}".format(POLICIES))
+    rng = rng or np.random.default_rng()
+    limits = np.asarray(triageTimeLimit, dtype="float64")
+    levels = len(limits)
+    replications = len(streams)
+    patients = max(max(len(stream["minutes"]) for stream in streams), 1)
+    table = rosterTable(roster)
+
+    # per replication and triage priority, a queue of patients in arrival order padded with never arriving patients
+    arrival = np.full((replications, patients + 1), np.inf)
+    triage = np.ones((replications, patients + 1), dtype="int64")
+    perLevel = max(max(np.bincount(stream["triage"], minlength=levels + 1).max() for stream in streams), 1)
+    queueArrival = np.full((replications, levels, perLevel + 1), np.inf)
+    queuePatient = np.full((replications, levels, perLevel + 1), patients, dtype="int64")
+    for row, stream in enumerate(streams):
+        count = len(stream["minutes"])
+        arrival[row, :count] = stream["minutes"]
+        triage[row, :count] = stream["triage"]
+        for level in range(levels):
+            members = np.flatnonzero(stream["triage"] == level + 1)
+            queueArrival[row, level, :len(members)] = stream["minutes"][members]
+            queuePatient[row, level, :len(members)] = members
+
+    mean = np.asarray(consultMinutes, dtype="float64")[triage - 1]
+    consult = rng.lognormal(np.log(mean) - consultSigma**2 / 2, consultSigma)
+    seen = np.full((replications, patients + 1), np.inf)
+    freeAt = np.zeros((replications, table.shape[0]))
+    head = np.zeros((replications, levels), dtype="int64")
+    rows = np.arange(replications)
+
+    while True:
+        heads = np.take_along_axis(queueArrival, head[:, :, np.newaxis], axis=2)[:, :, 0]
+        nextArrival = heads.min(axis=1)
+        if not np.isfinite(nextArrival).any():
+            break
+
+        # the first doctor able to start once a patient is waiting, then the patient the policy picks among those waiting by then
+        ready = _nextOnDuty(table, np.maximum(freeAt, nextArrival[:, np.newaxis]))
+        doctor = ready.argmin(axis=1)
+        start = ready[rows, doctor]
+        waiting = heads <= start[:, np.newaxis]
+        if policy == "strict":
+            level = waiting.argmax(axis=1)
+        elif policy == "fifo":
+            level = heads.argmin(axis=1)
+        else:
+            level = np.where(waiting, heads + limits, np.inf).argmin(axis=1)
+
+        # finished replications only write to the padding column
+        patient = queuePatient[rows, level, head[rows, level]]
+        seen[rows, patient] = start
+        freeAt[rows, doctor] = start + consult[rows, patient]
+        head[rows, level] = np.minimum(head[rows, level] + 1, perLevel)
+
+    metrics = []
+    for row, stream in enumerate(streams):
+        count = len(stream["minutes"])
+        wait = seen[row, :count] - arrival[row, :count]
+        late = wait - limits[triage[row, :count] - 1]
+        result = {"patients": count, "LateFlag": np.mean(late > 0), "LateSeenByDr median": np.median(late), "Wait mean (mins)": np.mean(wait),
+                  "Wait p90 (mins)": np.quantile(wait, 0.9), "TreatedLaterThanOrdering": np.nan}
+        if outOfOrder and count:
+            result["TreatedLaterThanOrdering"] = np.mean(_treatedLaterThanOrdering(arrival[row, :count], arrival[row, :count] + limits[triage[row, :count] - 1], seen[row, :count]))
+        for level in range(levels):
+            result["LateFlag triage {}".format(level + 1)] = np.mean(late[triage[row, :count] == level + 1] > 0) if (triage[row, :count] == level + 1).any() else np.nan
+        metrics.append(result)
+
+    return pd.DataFrame(metrics)
+
+def _runBatch(task):
+    scenario, source, days, replications, seed = task
+    rng = np.random.default_rng(seed)
+    if days is None:
+        streams = [source] * replications
+    else:
+        streams = [sampleArrivals(source, days, rng) for _ in range(replications)]
+    options = {key: scenario[key] for key in ("policy", "triageTimeLimit", "consultMinutes", "consultSigma", "outOfOrder") if key in scenario}
+
+    return simulateBatch(streams, scenario["roster"], rng=rng, **options)
+
+def simulateScenarios(scenarios, dataset, replications=1000, resampleDays=None, batchSize=100, processes=None, seed=0):
+    """Run replications of every scenario and collect their metrics.
+
+    Input:
+        scenarios - list of dictionaries with name, roster and optional policy, triageTimeLimit, consultMinutes, consultSigma and outOfOrder,
+                    see simulateBatch
+        dataset - transformed Generic ED 2009 dataset the arrival stream is taken from
+        replications - number of replications per scenario
+        resampleDays - None replays the dataset's arrivals in every replication, otherwise every replication samples this many days of arrivals
+                       from the dataset's hour of week profile
+        batchSize - number of replications simulated together in lockstep
+        processes - number of worker processes. None runs the batches in the current process
+        seed - seed of the random streams, batches get independent streams so results do not depend on processes
+
+    Output:
+        DataFrame with scenario, replication and the metrics of simulateBatch, one row per scenario replication
+    """
+    stream = arrivalStream(dataset)
+    source = stream if resampleDays is None else arrivalProfile(stream)
+    batches = [(scenario, start, min(batchSize, replications - start)) for scenario in scenarios for start in range(0, replications, batchSize)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    tasks = [(scenario, source, resampleDays, size, batchSeed) for (scenario, _, size), batchSeed in zip(batches, seeds)]
+
+    if processes is None or len(tasks) < 2:
+        results = [_runBatch(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(_runBatch, tasks))
+
+    for (scenario, start, size), result in zip(batches, results):
+        result.insert(0, "replication", np.arange(start, start + size))
+        result.insert(0, "scenario", scenario["name"])
+
+    return pd.concat(results, ignore_index=True)
+
+def summariseScenarios(results):
+    """Mean and 95% replication interval of every metric per scenario.
+    """
+    metrics = results.drop(columns=["replication"]).groupby("scenario", sort=False)
+
+    return pd.concat({"mean": metrics.mean(), "2.5%": metrics.quantile(0.025), "97.5%": metrics.quantile(0.975)}, axis=1).swaplevel(axis=1).sort_index(axis=1, level=0, sort_remaining=False)
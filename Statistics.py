@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 05/04/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module runs the battery of statistical tests of PopulationAnalysis.py (Shapiro, Mann-Whitney, t-test, OLS with interaction,
+          Tukey HSD and Lasso) across strata of the transformed dataset e.g. triage x month x day of week x site.
+          Columns are placed in shared memory once and strata are tested across a process pool, results are collected in one tidy table.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import warnings
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+
+VALUE_COLUMN = "LateSeenByDr"
+GROUP_COLUMN = "TreatedLaterThanOrdering"
+TRIAGE_COLUMN = "TriagePriority"
+RESULT_COLUMNS = ["test", "term", "statistic", "pvalue", "n"]
+
+# tests fitted on LateSeenByDr within the 3 standard deviation bounds, as in PopulationAnalysis.py
+TRIMMED_TESTS = ("ols", "tukey", "lasso")
+
+# smallest TreatedLaterThanOrdering group each scipy test accepts, smaller strata are reported rather than left to scipy's warnings
+MIN_GROUP_SIZES = {"shapiro": 3, "mannwhitneyu": 1, "ttest": 2}
+
+def summariseTukeyTest(tukeydf, factor):
+    """Function to analyse tukey test result. Count, per group, the statistically significant comparisons it is part of and whether it came out better or worse.
+    """
+    tukeyTrue = tukeydf.loc[tukeydf["reject"].astype(bool)]
+    worseFirst = tukeyTrue["meandiff"] < 0
+    better = pd.concat([tukeyTrue.loc[~worseFirst, "group1"], tukeyTrue.loc[worseFirst, "group2"]]).value_counts()
+    worse = pd.concat([tukeyTrue.loc[worseFirst, "group1"], tukeyTrue.loc[~worseFirst, "group2"]]).value_counts()
+
+    uniqueValues = sorted(set(tukeydf["group1"]) | set(tukeydf["group2"]))
+    tukeySummaryDf = pd.DataFrame({factor: uniqueValues})
+    tukeySummaryDf["Better"] = better.reindex(uniqueValues, fill_value=0).to_numpy()
+    tukeySummaryDf["Worse"] = worse.reindex(uniqueValues, fill_value=0).to_numpy()
+    tukeySummaryDf.insert(1, "StatisticallySignificantInstance", tukeySummaryDf["Better"] + tukeySummaryDf["Worse"])
+
+    return tukeySummaryDf
+
+def _groups(stratum):
+    values = stratum[VALUE_COLUMN]
+    return values[stratum[GROUP_COLUMN] == 0], values[stratum[GROUP_COLUMN] == 1]
+
+def shapiroTest(stratum):
+    """Shapiro-Wilk normality test of LateSeenByDr for each TreatedLaterThanOrdering group.
+    """
+    rows = []
+    for group, values in zip((0, 1), _groups(stratum)):
+        with warnings.catch_warnings():
+            # scipy warns the p-value may be inaccurate for n > 5000
+            warnings.simplefilter("ignore", UserWarning)
+            result = stats.shapiro(values)
+        rows.append({"term": "{} {}".format(GROUP_COLUMN, group), "statistic": result[0], "pvalue": result[1], "n": len(values)})
+
+    return rows
+
+def mannWhitneyTest(stratum):
+    """Mann-Whitney U test of LateSeenByDr between TreatedLaterThanOrdering groups.
+    """
+    group0, group1 = _groups(stratum)
+    result = stats.mannwhitneyu(group0, group1)
+
+    return [{"term": GROUP_COLUMN, "statistic": result[0], "pvalue": result[1], "n": len(group0) + len(group1)}]
+
+def tTest(stratum):
+    """Welch's t-test of LateSeenByDr between TreatedLaterThanOrdering groups.
+    """
+    group0, group1 = _groups(stratum)
+    result = stats.ttest_ind(group0, group1, equal_var=False)
+
+    return [{"term": GROUP_COLUMN, "statistic": result.statistic, "pvalue": result.pvalue, "n": len(group0) + len(group1)}]
+
+def medianTest(stratum):
+    """Median LateSeenByDr of each TreatedLaterThanOrdering group, reported as the statistic.
+    """
+    return [{"term": "{} {}".format(GROUP_COLUMN, group), "statistic": values.median(), "pvalue": np.nan, "n": len(values)}
+            for group, values in zip((0, 1), _groups(stratum))]
+
+def olsTest(stratum):
+    """OLS of LateSeenByDr on TreatedLaterThanOrdering interacted with TriagePriority, one row per coefficient.
+    """
+    import statsmodels.formula.api as sm_formula
+
+    formula = "{} ~ C({})*C({})".format(VALUE_COLUMN, GROUP_COLUMN, TRIAGE_COLUMN) if stratum[TRIAGE_COLUMN].nunique() > 1 else "{} ~ C({})".format(VALUE_COLUMN, GROUP_COLUMN)
+    lm = sm_formula.ols(formula, stratum).fit()
+
+    return [{"term": term, "statistic": lm.params[term], "pvalue": lm.pvalues[term], "n": int(lm.nobs)} for term in lm.params.index]
+
+def tukeyTest(stratum):
+    """Tukey HSD of LateSeenByDr across TreatedLaterThanOrdering/TriagePriority combinations, one row per pair of groups.
+    """
+    import statsmodels.stats.multicomp as sm_stats
+
+    groups = stratum[GROUP_COLUMN].astype(int).astype(str) + "/" + stratum[TRIAGE_COLUMN].astype(int).astype(str)
+    tukey = sm_stats.pairwise_tukeyhsd(stratum[VALUE_COLUMN], groups)
+    table = pd.DataFrame(data=tukey._results_table.data[1:], columns=tukey._results_table.data[0])
+
+    return [{"term": "{} vs {}".format(group1, group2), "statistic": meandiff, "pvalue": pvalue, "n": len(stratum), "reject": bool(reject)}
+            for group1, group2, meandiff, pvalue, reject in zip(table["group1"], table["group2"], table["meandiff"], table["p-adj"], table["reject"])]
+
+def lassoTest(stratum):
+    """Lasso of LateSeenByDr on TreatedLaterThanOrdering indicators, coefficients reported as statistics with the fit's R2.
+    """
+    from sklearn import linear_model
+
+    features = pd.DataFrame({"TreatedLaterThanOrdering_0": (stratum[GROUP_COLUMN] == 0).astype(float), "TreatedLaterThanOrdering_1": (stratum[GROUP_COLUMN] == 1).astype(float)})
+    reg = linear_model.Lasso()
+    reg.fit(features, stratum[VALUE_COLUMN])
+    rows = [{"term": column, "statistic": coef, "pvalue": np.nan, "n": len(stratum)} for column, coef in zip(features.columns, reg.coef_)]
+    rows.append({"term": "R2", "statistic": reg.score(features, stratum[VALUE_COLUMN]), "pvalue": np.nan, "n": len(stratum)})
+
+    return rows
+
+TESTS = {"shapiro": shapiroTest, "mannwhitneyu": mannWhitneyTest, "ttest": tTest, "median": medianTest, "ols": olsTest, "tukey": tukeyTest, "lasso": lassoTest}
+
+def defineStrata(dataset, dimensions):
+    """List every combination of values of the given dimensions present in the dataset.
+
+    Input:
+        dataset - transformed dataset
+        dimensions - list of column names e.g. ["TriagePriority", "ArrivalMonth", "ArrivalDayOfWeek"]. An empty list is the whole population
+
+    Output:
+        List of dictionaries of column name to value
+    """
+    if not dimensions:
+        return [{}]
+    present = dataset[list(dimensions)].dropna().drop_duplicates().sort_values(list(dimensions))
+
+    return [dict(zip(dimensions, values)) for values in present.itertuples(index=False)]
+
+def _runStratum(columns, stratum, tests, bounds):
+    """Run tests on one stratum of the columns, reporting failures (e.g. too few observations) as error rows.
+    """
+    mask = ~np.isnan(columns[VALUE_COLUMN])
+    for column, value in stratum.items():
+        mask &= columns[column] == value
+    data = pd.DataFrame({column: values[mask] for column, values in columns.items()})
+
+    groupSize = min(len(group) for group in _groups(data))
+    rows = []
+    for test in tests:
+        testData = data
+        if test in TRIMMED_TESTS and bounds is not None:
+            testData = data.loc[(data[VALUE_COLUMN] >= bounds[0]) & (data[VALUE_COLUMN] <= bounds[1])]
+        try:
+            if groupSize < MIN_GROUP_SIZES.get(test, 0):
+                raise ValueError("too few observations, {} per {} group needed".format(MIN_GROUP_SIZES[test], GROUP_COLUMN))
+            results = TESTS[test](testData)
+        except (ValueError, np.linalg.LinAlgError, ZeroDivisionError) as error:
+            results = [{"term": "error: {}".format(error), "statistic": np.nan, "pvalue": np.nan, "n": len(testData)}]
+        for result in results:
+            rows.append(dict(stratum, test=test, **result))
+
+    return rows
+
+_sharedColumns = {}
+_sharedBlocks = []
+
+def _attach(spec):
+    """Process pool initializer attaching to the shared column arrays.
+    """
+    for column, (name, dtype, length) in spec.items():
+        block = shared_memory.SharedMemory(name=name)
+        _sharedBlocks.append(block)
+        _sharedColumns[column] = np.ndarray((length,), dtype=dtype, buffer=block.buf)
+
+def _runShared(task):
+    """Process pool worker running a batch of strata over the shared columns.
+    """
+    strata, tests, bounds = task
+    rows = []
+    for stratum in strata:
+        rows += _runStratum(_sharedColumns, stratum, tests, bounds)
+
+    return rows
+
+def runTests(dataset, strata, tests=tuple(TESTS), bounds=None, processes=None, batchSize=8):
+    """Run a battery of statistical tests on every stratum of the transformed dataset.
+
+    Input:
+        dataset - transformed dataset with LateSeenByDr, TreatedLaterThanOrdering and TriagePriority columns
+        strata - list of dictionaries of column name to value, e.g. from defineStrata
+        tests - names of tests in TESTS to run on each stratum
+        bounds - optional (lower, upper) bounds on LateSeenByDr applied to the tests in TRIMMED_TESTS
+        processes - number of worker processes. None runs in the current process
+        batchSize - number of strata sent to a worker at a time
+
+    Output:
+        DataFrame with one row per stratum, test and term
+    """
+    stratumColumns = sorted({column for stratum in strata for column in stratum})
+    names = [VALUE_COLUMN, GROUP_COLUMN, TRIAGE_COLUMN] + [column for column in stratumColumns if column not in (VALUE_COLUMN, GROUP_COLUMN, TRIAGE_COLUMN)]
+    columns = {}
+    for column in names:
+        values = dataset[column]
+        # non numeric strata e.g. site are shared as category codes
+        if not pd.api.types.is_numeric_dtype(values):
+            categories = pd.Categorical(values)
+            values = pd.Series(categories.codes)
+            strata = [dict(stratum, **{column: categories.categories.get_loc(stratum[column])}) if column in stratum else stratum for stratum in strata]
+        columns[column] = values.to_numpy(dtype="float64")
+
+    if processes is None:
+        rows = []
+        for stratum in strata:
+            rows += _runStratum(columns, stratum, tests, bounds)
+    else:
+        blocks = []
+        spec = {}
+        try:
+            for column, values in columns.items():
+                block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+                np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+                blocks.append(block)
+                spec[column] = (block.name, values.dtype.str, len(values))
+            tasks = [(strata[start:start + batchSize], tests, bounds) for start in range(0, len(strata), batchSize)]
+            with ProcessPoolExecutor(max_workers=processes, initializer=_attach, initargs=(spec,)) as executor:
+                rows = [row for batch in executor.map(_runShared, tasks) for row in batch]
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    results = pd.DataFrame(rows)
+    for column in names:
+        if column in stratumColumns and not pd.api.types.is_numeric_dtype(dataset[column]):
+            results[column] = pd.Categorical(dataset[column]).categories[results[column].astype(int)]
+
+    return results[stratumColumns + RESULT_COLUMNS + [column for column in results.columns if column not in stratumColumns + RESULT_COLUMNS]] if len(results) else pd.DataFrame(columns=stratumColumns + RESULT_COLUMNS)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 27/03/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module stores the transformed dataset and ED wait room timeline between Transformation and PopulationAnalysis in a columnar format.
+          Stored results are keyed by a hash of the source dataset and the triage time limits, so unchanged inputs are never transformed twice.
+          The incremental store, which outlives any one source file, is keyed by a hash of the triage time limits alone.
+          Parquet and Feather both require pyarrow.
+"""
+
+import hashlib
+import json
+import os
+import pandas as pd
+
+DATASET_TABLE = "Dataset_ED_transformed"
+TIMELINE_TABLE = "ED Wait Room Timeline"
+STORE_FORMATS = {"parquet": ".parquet", "feather": ".feather"}
+# bumped whenever the transformation output changes, so results stored by an earlier version are not reused
+TRANSFORM_VERSION = 3
+
+def sourceHash(sourcePath, triageTimeLimit, blockSize=1 << 20):
+    """Hash the source dataset file together with the transformation config.
+
+    Input:
+        sourcePath - path to the source dataset e.g. Generic ED 2009.xlsx
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+        blockSize - number of bytes read from the source at a time
+
+    Output:
+        Hex digest identifying this source and config
+    """
+    digest = hashlib.sha256()
+    with open(sourcePath, "rb") as source:
+        for block in iter(lambda: source.read(blockSize), b""):
+            digest.update(block)
+    digest.update(_configJson(triageTimeLimit))
+
+    return digest.hexdigest()
+
+def _configJson(triageTimeLimit):
+    """Transformation config hashed into store keys.
+    """
+    return json.dumps({"triageTimeLimit": list(triageTimeLimit), "version": TRANSFORM_VERSION}).encode("utf-8")
+
+def incrementalKey(triageTimeLimit):
+    """Key of the incremental store for the transformation config, so changed triage time limits or a new TRANSFORM_VERSION start a new store.
+
+    Input:
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+
+    Output:
+        "incremental-" followed by the hex digest of the config
+    """
+    return "incremental-" + hashlib.sha256(_configJson(triageTimeLimit)).hexdigest()
+
+def tablePath(storeDir, key, table, storeFormat="parquet"):
+    """Path of a stored table.
+    """
+    return os.path.join(storeDir, key, table + STORE_FORMATS[storeFormat])
+
+def saveTables(tables, storeDir, key, storeFormat="parquet"):
+    """Write tables to the store under key. Each table is written to a temporary file first so an interrupted run never leaves a partial table.
+
+    Input:
+        tables - dictionary of table name to DataFrame
+        storeDir - root directory of the store
+        key - key from sourceHash
+        storeFormat - "parquet" or "feather"
+
+    Output:
+        None
+    """
+    os.makedirs(os.path.join(storeDir, key), exist_ok=True)
+    for table, df in tables.items():
+        path = tablePath(storeDir, key, table, storeFormat)
+        df = df.reset_index(drop=True)
+        if storeFormat == "parquet":
+            df.to_parquet(path + ".tmp", index=False)
+        else:
+            df.to_feather(path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    return
+
+def appendTable(df, storeDir, key, table, storeFormat="parquet"):
+    """Append rows to a table stored as numbered part files, so appending never rewrites earlier rows.
+
+    Input:
+        df - DataFrame of rows to append
+        storeDir - root directory of the store
+        key - key the table is stored under
+        table - table name
+        storeFormat - "parquet" or "feather"
+
+    Output:
+        None
+    """
+    partsDir = os.path.join(storeDir, key, table)
+    os.makedirs(partsDir, exist_ok=True)
+    part = len([name for name in os.listdir(partsDir) if name.endswith(STORE_FORMATS[storeFormat])])
+    saveTables({"part-{:05d}".format(part): df}, os.path.join(storeDir, key), table, storeFormat)
+
+    return
+
+def _readTable(path, storeFormat, memoryMap):
+    """Read one stored file.
+    """
+    if storeFormat == "parquet":
+        return pd.read_parquet(path, memory_map=memoryMap)
+
+    from pyarrow import feather
+
+    return feather.read_feather(path, memory_map=memoryMap)
+
+def loadTables(tables, storeDir, key, storeFormat="parquet", memoryMap=True):
+    """Read tables from the store under key.
+
+    Input:
+        tables - list of table names
+        storeDir - root directory of the store
+        key - key from sourceHash
+        storeFormat - "parquet" or "feather"
+        memoryMap - memory map stored files instead of reading them into memory up front
+
+    Output:
+        Dictionary of table name to DataFrame, or None if any table is missing. Tables written by appendTable are read part by part
+    """
+    loaded = {}
+    for table in tables:
+        path = tablePath(storeDir, key, table, storeFormat)
+        partsDir = os.path.join(storeDir, key, table)
+        if os.path.exists(path):
+            loaded[table] = _readTable(path, storeFormat, memoryMap)
+        elif os.path.isdir(partsDir):
+            parts = sorted(name for name in os.listdir(partsDir) if name.endswith(STORE_FORMATS[storeFormat]))
+            loaded[table] = pd.concat([_readTable(os.path.join(partsDir, name), storeFormat, memoryMap) for name in parts], ignore_index=True)
+        else:
+            return None
+
+    return loaded
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 02/04/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module maintains wait room occupancy, per triage counts and the "treated later than expected order" flag live from a stream of
+          arrival, triage, Dr seen and depart events, so the metrics of Transformation.py are available to operational dashboards.
+          Events are dictionaries e.g. {"event": "arrival", "time": "2009-01-01 10:00", "MRN": 1, "Presentation Visit Number": 1, "Triage Priority": 3}
+          with event one of arrival, triage, drseen and depart. Events sharing a timestamp are applied together once time moves past it,
+          which gives the strict inequalities of the batch calculation regardless of the order events arrive in within that instant.
+"""
+
+import asyncio
+import bisect
+import heapq
+from itertools import accumulate, chain
+import json
+import time as clock
+import numpy as np
+import pandas as pd
+
+EVENT_TYPES = ("arrival", "triage", "drseen", "depart")
+
+class _SeenCounts:
+    """Fenwick tree of point additions over snapshot numbers, giving prefix sums in O(log n). It grows as snapshots are taken and
+    rebase folds the points of snapshots no longer needed into the first point kept, so its size follows the snapshots still in use.
+    """
+
+    def __init__(self):
+        self.base = 0
+        self.points = []
+        self.tree = [0]
+
+    def _rebuild(self, capacity):
+        self.points += [0] * (capacity - len(self.points))
+        self.tree = [0] + self.points
+        for position in range(1, capacity + 1):
+            parent = position + (position & -position)
+            if parent <= capacity:
+                self.tree[parent] += self.tree[position]
+
+    def add(self, number, value):
+        position = number - self.base
+        if position >= len(self.points):
+            self._rebuild(max(2 * len(self.points), position + 1, 64))
+        self.points[position] += value
+        position += 1
+        while position < len(self.tree):
+            self.tree[position] += value
+            position += position & -position
+
+    def prefix(self, number):
+        """Sum of the points up to and including snapshot number.
+        """
+        position = min(number - self.base + 1, len(self.points))
+        total = 0
+        while position > 0:
+            total += self.tree[position]
+            position -= position & -position
+
+        return total
+
+    def rebase(self, number):
+        """Drop the points before snapshot number once they make up half the tree, their sum is carried by the point of number.
+        """
+        dropped = number - self.base
+        if dropped <= 0 or 2 * dropped < len(self.points):
+            return
+        carried = self.prefix(number)
+        self.points = [carried] + self.points[dropped + 1:]
+        self.base = number
+        self._rebuild(len(self.points))
+
+class EDStateProcessor:
+    """In-memory ED state updated one event at a time.
+
+    Input:
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+        onUpdate - optional callable receiving every emitted update
+
+    Updates are dictionaries. An "arrival" update holds TotalPatientsInEDWaitRoom, Triage 1-5 count and TotalPatientsInEDAtArrival
+    for the arriving patient. A "drseen" update holds TreatedLaterThanOrdering and LateSeenByDr for the patient seen.
+
+    A snapshot is taken at every arrival instant and shared by everyone waiting then, who hold it from the snapshot they joined the wait at until
+    they are seen. It keeps the waiting order, so a patient's expected ranking in it is a binary search when they are seen, and the number of its
+    patients already seen comes from a Fenwick tree keyed by snapshot number, so a Dr seen event is one O(log n) update whatever the queue depth.
+    """
+
+    def __init__(self, triageTimeLimit, onUpdate=None):
+        self.limits = [int(limit * 60 * 10**9) for limit in triageTimeLimit]
+        self.onUpdate = onUpdate
+        self.patients = {}
+        # per triage heaps of (expected Dr seen, sequence, key) of the patients waiting to be seen by a doctor. Patients of a triage mostly join
+        # at the end as expected Dr seen follows arrival, so they are kept fully sorted: their lengths are the running counts and the front is most overdue
+        self.heaps = {triage: [] for triage in range(1, len(triageTimeLimit) + 1)}
+        self.inEDCount = 0
+        self.sequence = 0
+        self.currentTime = None
+        self.pending = []
+        # snapshots (time, copies, waiting order) from the one numbered firstSnapshot on, trimmed once most are no longer held by a waiting patient
+        self.snapshots = []
+        self.firstSnapshot = 0
+        self.snapshotCount = 0
+        # a patient seen adds 1 from the snapshot they joined at and takes it off again from the next snapshot, so the prefix sum at a
+        # snapshot is the number of its patients seen since it was taken
+        self.seenCounts = _SeenCounts()
+        # heap of (snapshot joined at, sequence, key) of waiting patients, entries of patients no longer waiting are removed lazily
+        self.joined = []
+
+    def push(self, event):
+        """Add one event. Events must arrive in non-decreasing time order.
+
+        Output:
+            List of updates emitted because time moved past the previous instant
+        """
+        eventTime = pd.Timestamp(event["time"]).value
+        updates = []
+        if self.currentTime is not None and eventTime < self.currentTime:
+            raise ValueError("Event at {} arrived after {}".format(pd.Timestamp(eventTime), pd.Timestamp(self.currentTime)))
+        if self.currentTime is not None and eventTime > self.currentTime:
+            updates = self.flush()
+        self.currentTime = eventTime
+        self.pending.append(event)
+
+        return updates
+
+    def flush(self):
+        """Apply every pending event of the current instant.
+
+        Output:
+            List of updates
+        """
+        if not self.pending:
+            return []
+        now = self.currentTime
+        events = {eventType: [] for eventType in EVENT_TYPES}
+        for event in self.pending:
+            events[event["event"]].append(event)
+        self.pending = []
+        updates = []
+
+        arrivals = [self._register(event, now) for event in events["arrival"]]
+        for event in events["triage"]:
+            self._setTriage(self._key(event), int(event["Triage Priority"]))
+        updates += self._seen([self._key(event) for event in events["drseen"]], now)
+        for event in events["depart"]:
+            self._depart(self._key(event))
+        self._release()
+        updates += self._snapshot(arrivals, now)
+
+        if self.onUpdate is not None:
+            for update in updates:
+                self.onUpdate(update)
+
+        return updates
+
+    def overdue(self, triage, now=None):
+        """Patients of a triage priority still waiting past their expected Dr seen time, most overdue first.
+        """
+        now = self.currentTime if now is None else pd.Timestamp(now).value
+        heap = self.heaps[triage]
+
+        return [key for expected, sequence, key in heap[:bisect.bisect_left(heap, (now,))]]
+
+    def _key(self, event):
+        return (event["MRN"], event["Presentation Visit Number"])
+
+    def _register(self, event, now):
+        key = self._key(event)
+        patient = {"key": key, "arrival": now, "sequence": event.get("sequence", self.sequence), "triage": None, "expected": None,
+                   "waiting": event.get("countInWaitRoom", True), "inED": event.get("countInED", True), "stints": []}
+        self.sequence += 1
+        self.patients[key] = patient
+        if patient["inED"]:
+            self.inEDCount += 1
+        if event.get("Triage Priority") is not None:
+            self._setTriage(key, int(event["Triage Priority"]))
+
+        return key
+
+    def _setTriage(self, key, triage):
+        patient = self.patients[key]
+        if patient["waiting"] and patient["triage"] is not None:
+            self._removeWaiting(patient)
+        patient["triage"] = triage
+        patient["expected"] = patient["arrival"] + self.limits[triage - 1]
+        if patient["waiting"]:
+            entry = (patient["expected"], patient["sequence"], key)
+            bisect.insort(self.heaps[triage], entry)
+            # a stint is the first snapshot held with an unchanged entry in the waiting order, a new triage priority starts a new one
+            if not patient["stints"]:
+                heapq.heappush(self.joined, (self.snapshotCount, patient["sequence"], key))
+            patient["stints"].append((self.snapshotCount, entry))
+
+    def _removeWaiting(self, patient):
+        heap = self.heaps[patient["triage"]]
+        del heap[bisect.bisect_left(heap, (patient["expected"], patient["sequence"], patient["key"]))]
+
+    def _seen(self, keys, now):
+        seen = sorted((self.patients[key] for key in keys if key in self.patients and self.patients[key]["waiting"]), key=lambda patient: patient["sequence"])
+        updates = []
+        for patient in seen:
+            # patients seen at the same instant tie on actual Dr seen time and rank by sequence
+            others = [(other["stints"][0][0], other["sequence"]) for other in seen if other is not patient and other["stints"]]
+            late = int(self._rankedLater(patient, others))
+            updates.append({"event": "drseen", "MRN": patient["key"][0], "Presentation Visit Number": patient["key"][1], "Dr Seen Date": pd.Timestamp(now),
+                            "TreatedLaterThanOrdering": late, "LateSeenByDr": (now - patient["expected"]) / 60e9 if patient["expected"] is not None else np.nan})
+
+        for patient in seen:
+            if patient["triage"] is not None:
+                self._removeWaiting(patient)
+                # one more patient seen in every snapshot held, i.e. from the one joined at up to the latest
+                self.seenCounts.add(patient["stints"][0][0], 1)
+                self.seenCounts.add(self.snapshotCount, -1)
+            patient["waiting"] = False
+
+        return updates
+
+    def _rankedLater(self, patient, others):
+        """Whether a patient's actual ranking exceeds their expected ranking in any snapshot they hold.
+        A snapshot taken for k simultaneous arrivals appears k times in the batch timeline, and each copy of the patient is ranked
+        by method="first" over all copies: rank = k * earlier + copy * (ties + 1) + earlier ties. The comparison is linear in the copy,
+        so checking the first and last copy is enough.
+
+        Input:
+            patient - patient being seen
+            others - (snapshot joined at, sequence) of the other patients seen at the same instant
+        """
+        stints = patient["stints"] + [(self.snapshotCount, None)]
+        for (first, entry), (last, _) in zip(stints[:-1], stints[1:]):
+            if first == last:
+                continue
+            # patients of the snapshot seen before this instant, from the prefix sum at the first snapshot and the points after it
+            points = self.seenCounts.points[first - self.seenCounts.base + 1:last - self.seenCounts.base]
+            snapshots = self.snapshots[first - self.firstSnapshot:last - self.firstSnapshot]
+            for number, (snapshotTime, copies, order), actualEarlier in zip(range(first, last), snapshots, accumulate(points, initial=self.seenCounts.prefix(first))):
+                expectedEarlier = bisect.bisect_left(order, (entry[0],))
+                expectedTies = bisect.bisect_left(order, (entry[0] + 1,)) - expectedEarlier - 1
+                expectedTiesBefore = bisect.bisect_left(order, entry) - expectedEarlier
+                members = [sequence for joined, sequence in others if joined <= number]
+                actualTies = len(members)
+                actualTiesBefore = sum(1 for sequence in members if sequence < patient["sequence"])
+                for copy in (0, copies - 1):
+                    actual = copies * actualEarlier + copy * (actualTies + 1) + actualTiesBefore
+                    expected = copies * expectedEarlier + copy * (expectedTies + 1) + expectedTiesBefore
+                    if actual > expected:
+                        return True
+
+        return False
+
+    def _depart(self, key):
+        patient = self.patients.pop(key, None)
+        if patient is None:
+            return
+        if patient["inED"]:
+            self.inEDCount -= 1
+        if patient["waiting"] and patient["triage"] is not None:
+            self._removeWaiting(patient)
+
+    def _release(self):
+        """Drop the snapshots no waiting patient holds any more, once they are most of those kept.
+        """
+        while self.joined:
+            first, sequence, key = self.joined[0]
+            patient = self.patients.get(key)
+            if patient is not None and patient["sequence"] == sequence and patient["waiting"]:
+                break
+            heapq.heappop(self.joined)
+        oldest = self.joined[0][0] if self.joined else self.snapshotCount
+        if 2 * (oldest - self.firstSnapshot) >= len(self.snapshots):
+            del self.snapshots[:oldest - self.firstSnapshot]
+            self.firstSnapshot = oldest
+        self.seenCounts.rebase(oldest)
+
+    def _snapshot(self, arrivals, now):
+        if not arrivals:
+            return []
+        arrived = [self.patients[key] for key in arrivals if key in self.patients]
+        counts = {triage: len(heap) for triage, heap in self.heaps.items()}
+        inED = self.inEDCount
+        for patient in arrived:
+            if patient["waiting"] and patient["triage"] is not None:
+                counts[patient["triage"]] -= 1
+            if patient["inED"]:
+                inED -= 1
+
+        # everyone waiting now shares this snapshot, their expected ranking follows the waiting order with ties on expected Dr seen time
+        self.snapshots.append((now, len(arrivals), sorted(chain.from_iterable(self.heaps.values()))))
+        self.snapshotCount += 1
+
+        updates = []
+        for patient in sorted(arrived, key=lambda patient: patient["sequence"]):
+            update = {"event": "arrival", "MRN": patient["key"][0], "Presentation Visit Number": patient["key"][1], "Arrival Date": pd.Timestamp(now),
+                      "TotalPatientsInEDWaitRoom": sum(counts.values()), "TotalPatientsInEDAtArrival": inED}
+            for triage, count in counts.items():
+                update["Triage {} count".format(triage)] = count
+            updates.append(update)
+
+        return updates
+
+def process(events, triageTimeLimit):
+    """Run a finite event stream through a processor.
+
+    Input:
+        events - iterable of event dictionaries in time order
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+
+    Output:
+        Tuple of (list of updates, mean microseconds spent per event)
+    """
+    processor = EDStateProcessor(triageTimeLimit)
+    updates = []
+    count = 0
+    start = clock.perf_counter()
+    for event in events:
+        updates += processor.push(event)
+        count += 1
+    updates += processor.flush()
+    elapsed = clock.perf_counter() - start
+
+    return updates, (elapsed / count * 10**6) if count else 0.0
+
+def tailEvents(path, follow=True, pollInterval=0.5):
+    """Read JSON line events from a file, optionally waiting for new lines as the file grows.
+
+    Input:
+        path - path to a JSON lines file of events
+        follow - keep waiting for new events at the end of the file
+        pollInterval - seconds between checks for new lines
+
+    Output:
+        Generator of event dictionaries
+    """
+    with open(path) as eventFile:
+        while True:
+            line = eventFile.readline()
+            if line:
+                if line.strip():
+                    yield json.loads(line)
+            elif follow:
+                clock.sleep(pollInterval)
+            else:
+                return
+
+async def consumeQueue(queue, processor):
+    """Feed events from an asyncio queue into a processor until a None event is received.
+
+    Input:
+        queue - asyncio.Queue of event dictionaries
+        processor - EDStateProcessor, updates are delivered through its onUpdate callable
+
+    Output:
+        None
+    """
+    while True:
+        event = await queue.get()
+        if event is None:
+            processor.flush()
+            queue.task_done()
+            return
+        processor.push(event)
+        queue.task_done()
+        # let producers run between events
+        await asyncio.sleep(0)
+
+def eventsFromDataset(dataset):
+    """Build the event stream a dataset would have produced live, in time order.
+    Patients never seen by a doctor or without a departure are flagged so they are not counted, as in the batch calculation.
+
+    Input:
+        dataset - Generic ED 2009 dataset
+
+    Output:
+        List of event dictionaries
+    """
+    events = []
+    for sequence, row in enumerate(dataset[["MRN", "Presentation Visit Number", "Arrival Date", "Triage Priority", "Dr Seen Date", "Depart Actual Date"]].itertuples(index=False)):
+        mrn, visit, arrival, triage, seen, depart = row
+        if pd.isna(arrival):
+            continue
+        key = {"MRN": mrn, "Presentation Visit Number": visit}
+        waits = not pd.isna(seen) and seen > arrival
+        departs = not pd.isna(depart) and depart > arrival
+        events.append((arrival, 0, sequence, dict(key, event="arrival", time=arrival, sequence=sequence, countInWaitRoom=waits, countInED=departs, **{"Triage Priority": triage})))
+        if waits:
+            events.append((seen, 1, sequence, dict(key, event="drseen", time=seen)))
+        if departs:
+            events.append((depart, 2, sequence, dict(key, event="depart", time=depart)))
+    events.sort(key=lambda event: event[:3])
+
+    return [event[3] for event in events]
+
+def replay(dataset, triageTimeLimit):
+    """Replay a dataset through the stream processor and compare its output with the batch calculation.
+
+    Input:
+        dataset - Generic ED 2009 dataset, (MRN, Presentation Visit Number) unique
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+
+    Output:
+        Tuple of (DataFrame of stream vs batch columns per row, dictionary of mismatch counts per column and mean microseconds per event)
+    """
+    from Occupancy import countPatientsAtArrival
+    from Timeline import buildTimeline, rankTimeline, flagTreatedLaterThanOrdering
+
+    updates, microseconds = process(eventsFromDataset(dataset), triageTimeLimit)
+    keys = ["MRN", "Presentation Visit Number"]
+    arrivals = pd.DataFrame([update for update in updates if update["event"] == "arrival"]).drop(columns=["event", "Arrival Date"])
+    seen = pd.DataFrame([update for update in updates if update["event"] == "drseen"], columns=keys + ["TreatedLaterThanOrdering"])
+    stream = dataset[keys].merge(arrivals, how="left", on=keys).merge(seen[keys + ["TreatedLaterThanOrdering"]], how="left", on=keys)
+    stream["TreatedLaterThanOrdering"] = stream["TreatedLaterThanOrdering"].fillna(0)
+
+    batch = dataset[keys].copy()
+    triageCounts = countPatientsAtArrival(dataset, groupColumn="Triage Priority", groupValues=range(1, len(triageTimeLimit) + 1))
+    batch["TotalPatientsInEDWaitRoom"] = sum(triageCounts.values())
+    for triage, counts in triageCounts.items():
+        batch["Triage {} count".format(triage)] = counts
+    batch["TotalPatientsInEDAtArrival"] = countPatientsAtArrival(dataset, endColumn="Depart Actual Date")
+    batch["TreatedLaterThanOrdering"] = flagTreatedLaterThanOrdering(dataset, rankTimeline(buildTimeline(dataset, triageTimeLimit)))
+
+    columns = [column for column in batch.columns if column not in keys]
+    comparison = stream.join(batch[columns].reset_index(drop=True), rsuffix=" (batch)")
+    mismatches = {column: int((comparison[column].to_numpy() != comparison[column + " (batch)"].to_numpy()).sum()) for column in columns}
+    mismatches["microseconds per event"] = microseconds
+
+    return comparison, mismatches
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 11/04/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module generates synthetic ED presentations with the columns of Generic ED 2009.xlsx, so the pipeline can be measured
+          without patient data. Arrivals follow a daily and hourly profile, waits and treatment times are log-normal by triage priority.
+"""
+
+import numpy as np
+import pandas as pd
+
+# share of presentations per triage priority 1 to 5
+TRIAGE_MIX = [0.01, 0.1, 0.35, 0.42, 0.12]
+# relative arrival rate by hour of day, ED arrivals peak late morning and early evening
+HOURLY_PROFILE = [0.45, 0.35, 0.3, 0.25, 0.25, 0.3, 0.45, 0.7, 1.0, 1.25, 1.35, 1.35, 1.3, 1.25, 1.2, 1.2, 1.2, 1.25, 1.3, 1.25, 1.1, 0.95, 0.8, 0.6]
+# median minutes from arrival to Dr seen by triage priority
+MEDIAN_WAIT = [3, 12, 35, 55, 70]
+DEPART_STATUS_CODES = {"H": 0.62, "A": 0.25, "T": 0.03, "L": 0.04, "DNW": 0.03, "ZZ": 0.02, "D": 0.01}
+
+def generateDataset(rows, start="2009-01-01", arrivalsPerDay=150, triageMix=TRIAGE_MIX, hourlyProfile=HOURLY_PROFILE, medianWait=MEDIAN_WAIT,
+                    departStatusCodes=DEPART_STATUS_CODES, notSeenRate=0.02, sites=None, seed=0):
+    """Generate a synthetic ED dataset.
+
+    Input:
+        rows - number of presentations
+        start - date of the first day of arrivals
+        arrivalsPerDay - mean number of arrivals per day, sets the time span covered by rows
+        triageMix - share of presentations per triage priority 1 to 5
+        hourlyProfile - relative arrival rate for each of the 24 hours of the day
+        medianWait - median minutes from arrival to Dr seen by triage priority
+        departStatusCodes - dictionary of Depart Status Code to share of presentations, including ZZ/D rows marked for deletion
+        notSeenRate - share of presentations without a Dr Seen Date
+        sites - number of sites presentations are spread over, None leaves out the Site column
+        seed - random seed
+
+    Output:
+        DataFrame sorted by Arrival Date with the columns of the Generic ED Data sheet
+    """
+    rng = np.random.default_rng(seed)
+    days = max(int(np.ceil(rows / arrivalsPerDay)), 1)
+
+    # arrivals: day uniformly, hour by the hourly profile, minute uniformly within the hour
+    hourWeights = np.asarray(hourlyProfile, dtype="float64") / np.sum(hourlyProfile)
+    minutes = rng.integers(0, days, rows) * 1440 + rng.choice(24, rows, p=hourWeights) * 60 + rng.integers(0, 60, rows)
+    minutes.sort()
+    arrival = pd.Timestamp(start) + pd.to_timedelta(minutes, unit="min")
+
+    triage = rng.choice(np.arange(1, len(triageMix) + 1), rows, p=np.asarray(triageMix) / np.sum(triageMix))
+    waitMedian = np.asarray(medianWait, dtype="float64")[triage - 1]
+    wait = np.round(rng.lognormal(np.log(waitMedian), 0.8)).astype("int64")
+    treatment = np.round(rng.lognormal(np.log(150), 0.7)).astype("int64") + 1
+    seen = arrival + pd.to_timedelta(wait, unit="min")
+    depart = seen + pd.to_timedelta(treatment, unit="min")
+
+    codes = list(departStatusCodes)
+    status = rng.choice(codes, rows, p=np.asarray([departStatusCodes[code] for code in codes]) / sum(departStatusCodes.values()))
+
+    # repeat presentations share an MRN, visit numbers are unique
+    mrn = rng.integers(1000000, 1000000 + max(int(rows * 0.7), 1), rows)
+
+    dataset = pd.DataFrame({
+        "MRN": mrn,
+        "Presentation Visit Number": np.arange(rows) + 5000000,
+        " Age  (yrs)": np.clip(np.round(rng.gamma(2.2, 18, rows)), 0, 105).astype("int64"),
+        "Arrival Date": arrival,
+        "Triage Priority": triage,
+        "Dr Seen Date": seen,
+        "Depart Actual Date": depart,
+        "Depart Status Code": status,
+    })
+    dataset.loc[rng.random(rows) < notSeenRate, "Dr Seen Date"] = pd.NaT
+    if sites is not None:
+        dataset["Site"] = rng.integers(1, sites + 1, rows)
+    dataset["TimeDiff Arrival-TreatDrNr (mins)"] = (dataset["Dr Seen Date"] - dataset["Arrival Date"]).dt.total_seconds() / 60.0
+    dataset["Calculated Arrival-TreatDrNr (mins)"] = dataset["TimeDiff Arrival-TreatDrNr (mins)"]
+    dataset["TimeDiff TreatDrNr-Act. Depart (mins)"] = (dataset["Depart Actual Date"] - dataset["Dr Seen Date"]).dt.total_seconds() / 60.0
+    dataset["TimeDiff Arrival-Actual Depart (mins)"] = (dataset["Depart Actual Date"] - dataset["Arrival Date"]).dt.total_seconds() / 60.0
+
+    return dataset
+
+def writeDataset(dataset, path):
+    """Write a synthetic dataset in the layout of Generic ED 2009.xlsx. Excel sheets are limited to 1,048,575 data rows.
+    """
+    dataset.to_excel(path, sheet_name="Generic ED Data", index=False)
+
+    return
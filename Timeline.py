@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+@author: An Binh (Jason) Nguyen
+@date: 21/03/2021
+@introduction: Optimmisations around ED wait time and staffing are highly desireable in a world where detailed records of patience visits are kept by hospitals.
+@purpose: This module builds the ED wait room timeline i.e. a snapshot of every patient waiting to be seen by a doctor at each new patient's arrival.
+          The timeline is an interval self-join of arrival instants against [Arrival Date, Dr Seen Date) intervals, computed with array operations.
+          The timeline index holds only the snapshot and patient row positions into the transformed dataset and the int32 rankings,
+          patient attributes are gathered from the dataset when needed with expandTimeline.
+"""
+
+import numpy as np
+import pandas as pd
+from Occupancy import toEpoch
+from Features import expectedDrSeen
+
+TIMELINE_COLUMNS = ["Datetime", "MRN", "Presentation Visit Number", "Arrival Date", "Triage Priority", "Expected Dr Seen", "Actual Dr Seen"]
+TIMELINE_INDEX_COLUMNS = ["Snapshot", "Patient", "Actual Ranking", "Expected Ranking"]
+
+def joinSnapshots(queryTimes, startTimes, endTimes):
+    """Pair every query time t with every interval where start <= t and end > t.
+
+    Input:
+        queryTimes - int64 numpy array of snapshot times
+        startTimes - int64 numpy array of interval starts
+        endTimes - int64 numpy array of interval ends
+
+    Output:
+        Tuple of (query positions, interval positions) numpy arrays, ordered by query position then interval position
+    """
+    queryOrder = np.argsort(queryTimes, kind="stable")
+    sortedQueries = queryTimes[queryOrder]
+
+    # each interval covers a contiguous run of the sorted snapshot times
+    lo = np.searchsorted(sortedQueries, startTimes, side="left")
+    hi = np.searchsorted(sortedQueries, endTimes, side="left")
+    lengths = np.maximum(hi - lo, 0)
+    total = int(lengths.sum())
+
+    intervalPositions = np.repeat(np.arange(len(startTimes)), lengths)
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    queryPositions = queryOrder[np.repeat(lo, lengths) + offsets]
+
+    order = np.lexsort((intervalPositions, queryPositions))
+
+    return queryPositions[order], intervalPositions[order]
+
+def _timelineSource(dataset, triageTimeLimit):
+    """Extract the columns the timeline is gathered from as numpy arrays, so blocks can be gathered without touching dataset again.
+    """
+    return {
+        "Datetime": dataset["Arrival Date"].to_numpy(),
+        "MRN": dataset["MRN"].to_numpy(),
+        "Presentation Visit Number": dataset["Presentation Visit Number"].to_numpy(),
+        "Arrival Date": dataset["Arrival Date"].to_numpy(),
+        "Triage Priority": dataset["Triage Priority"].to_numpy(),
+        "Expected Dr Seen": expectedDrSeen(dataset, triageTimeLimit).to_numpy(),
+        "Actual Dr Seen": dataset["Dr Seen Date"].to_numpy(),
+    }
+
+def _buildColumns(source, queryPositions, patientPositions):
+    """Gather timeline columns for the given (snapshot row, patient row) pairs.
+    """
+    columns = {column: values[patientPositions] for column, values in source.items()}
+    columns["Datetime"] = source["Datetime"][queryPositions]
+
+    return pd.DataFrame(columns, columns=TIMELINE_COLUMNS)
+
+def _usableIntervals(dataset):
+    """Return epoch arrival/Dr seen times and the positions of patients that can appear in a snapshot.
+    """
+    arrivalTimes, arrivalNaT = toEpoch(dataset["Arrival Date"])
+    seenTimes, seenNaT = toEpoch(dataset["Dr Seen Date"])
+    usable = np.flatnonzero(~(arrivalNaT | seenNaT))
+
+    return arrivalTimes, arrivalNaT, seenTimes, usable
+
+def buildTimeline(dataset, triageTimeLimit):
+    """Build the ED wait room timeline. For every row of dataset, in row order, the timeline holds one row per patient
+    with Arrival Date <= that row's Arrival Date < Dr Seen Date, in row order.
+
+    Input:
+        dataset - Generic ED 2009 dataset
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+
+    Output:
+        DataFrame with columns Datetime, MRN, Presentation Visit Number, Arrival Date, Triage Priority, Expected Dr Seen, Actual Dr Seen
+    """
+    arrivalTimes, arrivalNaT, seenTimes, usable = _usableIntervals(dataset)
+    queries = np.flatnonzero(~arrivalNaT)
+
+    queryPositions, patientPositions = joinSnapshots(arrivalTimes[queries], arrivalTimes[usable], seenTimes[usable])
+
+    return _buildColumns(_timelineSource(dataset, triageTimeLimit), queries[queryPositions], usable[patientPositions])
+
+def iterateTimeline(dataset, triageTimeLimit, window="7D"):
+    """Build the ED wait room timeline in blocks of snapshot time so that the full timeline never has to be held in memory.
+    Each block holds the snapshots whose Datetime falls in [windowStart, windowStart + window). For a dataset sorted by
+    Arrival Date, concatenating the blocks gives the same result as buildTimeline.
+
+    Input:
+        dataset - Generic ED 2009 dataset
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+        window - pandas timedelta string or Timedelta for the length of each block
+
+    Output:
+        Generator of timeline DataFrames, one per non-empty window
+    """
+    arrivalTimes, arrivalNaT, seenTimes, usable = _usableIntervals(dataset)
+    queries = np.flatnonzero(~arrivalNaT)
+    if len(queries) == 0:
+        return
+
+    source = _timelineSource(dataset, triageTimeLimit)
+    step = pd.Timedelta(window).value
+    queryTimes = arrivalTimes[queries]
+    first = queryTimes.min()
+    last = queryTimes.max()
+
+    # patients sorted by arrival so each window only joins against those that arrived before it closed
+    usable = usable[np.argsort(arrivalTimes[usable], kind="stable")]
+    usableArrivals = arrivalTimes[usable]
+
+    windowStart = first
+    while windowStart <= last:
+        windowEnd = windowStart + step
+        windowQueries = queries[(queryTimes >= windowStart) & (queryTimes < windowEnd)]
+        if len(windowQueries) > 0:
+            candidates = usable[:np.searchsorted(usableArrivals, windowEnd, side="left")]
+            candidates = np.sort(candidates[seenTimes[candidates] > windowStart])
+            queryPositions, patientPositions = joinSnapshots(arrivalTimes[windowQueries], arrivalTimes[candidates], seenTimes[candidates])
+            yield _buildColumns(source, windowQueries[queryPositions], candidates[patientPositions])
+        windowStart = windowEnd
+
+def buildTimelineIndex(dataset):
+    """Build the ED wait room timeline as row positions. Rows are in the order of buildTimeline.
+
+    Input:
+        dataset - Generic ED 2009 dataset
+
+    Output:
+        DataFrame with int32 columns Snapshot (position of the row whose arrival is the snapshot) and Patient (position of the waiting patient)
+    """
+    arrivalTimes, arrivalNaT, seenTimes, usable = _usableIntervals(dataset)
+    queries = np.flatnonzero(~arrivalNaT)
+
+    queryPositions, patientPositions = joinSnapshots(arrivalTimes[queries], arrivalTimes[usable], seenTimes[usable])
+
+    return pd.DataFrame({"Snapshot": queries[queryPositions].astype("int32"), "Patient": usable[patientPositions].astype("int32")})
+
+def snapshotRanks(snapshotTimes, values, missing=None):
+    """Rank values within each snapshot time as groupby(snapshot time).rank(method="first") does, ties and repeated snapshots broken by row order.
+
+    Input:
+        snapshotTimes - numpy array of the snapshot time of every row, rows of one snapshot time need not be adjacent
+        values - numpy array of the values to rank
+        missing - boolean numpy array of values left unranked, or None
+
+    Output:
+        int32 numpy array of 1 based ranks, 0 where missing
+    """
+    rows = np.arange(len(values))
+    missing = np.zeros(len(values), dtype=bool) if missing is None else missing
+    # missing values sort after every ranked value of their snapshot
+    order = np.lexsort((rows, values, missing, snapshotTimes))
+    sortedTimes = snapshotTimes[order]
+    starts = np.flatnonzero(np.r_[True, sortedTimes[1:] != sortedTimes[:-1]]) if len(values) else rows
+    groupStart = np.repeat(starts, np.diff(np.r_[starts, len(values)]))
+    ranks = np.empty(len(values), dtype="int32")
+    ranks[order] = rows - groupStart + 1
+    ranks[missing] = 0
+
+    return ranks
+
+def rankTimelineIndex(timelineIndex, dataset):
+    """Rank every patient within each snapshot by actual and expected Dr seen time, as rankTimeline ranks the expanded timeline.
+
+    Input:
+        timelineIndex - timeline index from buildTimelineIndex, positions into dataset
+        dataset - transformed dataset with Expected Dr Seen
+
+    Output:
+        timelineIndex with int32 Actual Ranking and Expected Ranking columns added, 0 where the Dr seen time is missing
+    """
+    snapshot = timelineIndex["Snapshot"].to_numpy()
+    patient = timelineIndex["Patient"].to_numpy()
+    snapshotTimes = toEpoch(dataset["Arrival Date"])[0][snapshot]
+    actual, actualNaT = toEpoch(dataset["Dr Seen Date"])
+    expected, expectedNaT = toEpoch(dataset["Expected Dr Seen"])
+
+    timelineIndex["Actual Ranking"] = snapshotRanks(snapshotTimes, actual[patient], actualNaT[patient])
+    timelineIndex["Expected Ranking"] = snapshotRanks(snapshotTimes, expected[patient], expectedNaT[patient])
+
+    return timelineIndex
+
+def flagTimelineIndex(dataset, timelineIndex):
+    """Flag patients who were seen later than their expected ordering in at least one snapshot of the ranked timeline index.
+
+    Output:
+        pandas Series of bool flags aligned with dataset
+    """
+    ranked = (timelineIndex["Actual Ranking"] > 0) & (timelineIndex["Expected Ranking"] > 0)
+    late = ranked & (timelineIndex["Actual Ranking"] > timelineIndex["Expected Ranking"])
+    flags = np.zeros(len(dataset), dtype=bool)
+    flags[timelineIndex.loc[late, "Patient"].to_numpy()] = True
+
+    return pd.Series(flags, index=dataset.index)
+
+def expandTimeline(timelineIndex, dataset, triageColumn="Triage Priority"):
+    """Gather patient attributes onto the timeline index, giving the columns of buildTimeline and rankTimeline.
+
+    Input:
+        timelineIndex - timeline index, positions into dataset
+        dataset - transformed dataset
+        triageColumn - name of the triage priority column in dataset
+
+    Output:
+        DataFrame with TIMELINE_COLUMNS and, if ranked, float Actual Ranking and Expected Ranking columns
+    """
+    snapshot = timelineIndex["Snapshot"].to_numpy()
+    patient = timelineIndex["Patient"].to_numpy()
+    timeline = pd.DataFrame({
+        "Datetime": dataset["Arrival Date"].to_numpy()[snapshot],
+        "MRN": dataset["MRN"].to_numpy()[patient],
+        "Presentation Visit Number": dataset["Presentation Visit Number"].to_numpy()[patient],
+        "Arrival Date": dataset["Arrival Date"].to_numpy()[patient],
+        "Triage Priority": dataset[triageColumn].to_numpy()[patient],
+        "Expected Dr Seen": dataset["Expected Dr Seen"].to_numpy()[patient],
+        "Actual Dr Seen": dataset["Dr Seen Date"].to_numpy()[patient],
+    })
+    for column in ("Actual Ranking", "Expected Ranking"):
+        if column in timelineIndex.columns:
+            timeline[column] = timelineIndex[column].to_numpy().astype("float64")
+            timeline.loc[timeline[column] == 0, column] = np.nan
+
+    return timeline
+
+def rankTimeline(timeline):
+    """Rank every patient within each snapshot by actual and expected Dr seen time, ties broken by timeline order.
+
+    Input:
+        timeline - ED wait room timeline from buildTimeline
+
+    Output:
+        timeline with Actual Ranking and Expected Ranking columns added
+    """
+    snapshots = timeline.groupby("Datetime", sort=False)
+    timeline["Actual Ranking"] = snapshots["Actual Dr Seen"].rank(method="first", ascending=True)
+    timeline["Expected Ranking"] = snapshots["Expected Dr Seen"].rank(method="first", ascending=True)
+
+    return timeline
+
+def flagTreatedLaterThanOrdering(dataset, timeline):
+    """Flag patients who were seen later than their expected ordering in at least one snapshot of the ranked timeline.
+
+    Input:
+        dataset - Generic ED 2009 dataset
+        timeline - ranked ED wait room timeline from rankTimeline
+
+    Output:
+        pandas Series of 1/0 flags aligned with dataset
+    """
+    late = timeline["Actual Ranking"] > timeline["Expected Ranking"]
+    latePresentations = pd.MultiIndex.from_arrays([timeline.loc[late, "MRN"], timeline.loc[late, "Presentation Visit Number"]])
+    presentations = pd.MultiIndex.from_arrays([dataset["MRN"], dataset["Presentation Visit Number"]])
+
+    return pd.Series(presentations.isin(latePresentations).astype("float64"), index=dataset.index)
@@ -6,92 +6,220 @@
 @purpose: This script transforms original dataset to:
                 1. Clean data
                 2. Calculate metrics of interest
+          Transformed results are kept in a columnar store keyed by the source dataset and triage time limits, Excel and gzip CSV exports are optional.
 """
 
+from functools import partial
+import os
+import shutil
+import sys
+import numpy as np
 import pandas as pd
-import datetime
-
-# read dataset
-Dataset_ED = pd.read_excel("Generic ED 2009.xlsx", sheet_name="Generic ED Data")
-
-# drop unwanted data i.e. patients for deletion
-Dataset_ED.drop(index=Dataset_ED.loc[Dataset_ED["Depart Status Code"].isin(["ZZ", "D"])].index, inplace=True)
-
-# calculate hour value for each patient's arrival
-Dataset_ED["Arrival Hour"] = Dataset_ED["Arrival Date"].dt.hour
-# calculate month value for each patient's arrival
-Dataset_ED["Arrival Month"] = Dataset_ED["Arrival Date"].dt.month
-# calculate day of week value
-Dataset_ED["Arrival Day Of Week"] = Dataset_ED["Arrival Date"].dt.dayofweek
-
-# calculate total patients in ED at the point of new patient's arrival
-# generate table of patients currently presenting at each arrival time
-# calculate ranking for dr seen to see where there is a discrepancy between the order in which a patient requires medical attention vs what actually happened
+from Occupancy import countPatientsAtArrival
+from Timeline import buildTimelineIndex, rankTimelineIndex, flagTimelineIndex
+from Schema import compactDataset, compactTimeline
+from Features import deriveFeatures
+from Store import sourceHash, incrementalKey, saveTables, appendTable, loadTables, DATASET_TABLE, TIMELINE_TABLE
+from Profiling import RunReport, reportFromArguments
+from Partition import transformPartitioned, SITE_COLUMN
+from Incremental import incrementalState, transformIncrement, saveState, loadState, loadIncremental, REFLAGGED_TABLE
+from Intervals import buildIntervalIndex, saveIntervalIndex, appendIntervalIndex, loadIntervalIndex
+from Cube import buildCube, addCubes, saveCube, loadCube
+from Export import writeExcel, writeCsv, timelineChunks, EXPORT_DIR
+
+SOURCE_PATH = "Generic ED 2009.xlsx"
+STORE_DIR = "store"
 triageTimeLimit = [2, 10, 30, 60, 120]
-TotalPatientsInEDAtArrival = [0 for i in range(len(Dataset_ED))]
-CurrentPresentations = {"Datetime": [], "MRN": [], "Presentation Visit Number": [], "Arrival Date": [], "Triage Priority": [], "Expected Dr Seen":[], "Actual Dr Seen": []}
-TriagePriorityCount = {"Triage 1 count": [0 for i in range(len(Dataset_ED))], "Triage 2 count": [0 for i in range(len(Dataset_ED))], "Triage 3 count": [0 for i in range(len(Dataset_ED))], "Triage 4 count": [0 for i in range(len(Dataset_ED))], "Triage 5 count": [0 for i in range(len(Dataset_ED))]}
-for i in range(len(Dataset_ED)):
-    currentArrivalDate = Dataset_ED.iloc[i]["Arrival Date"]
-    current_presentations = Dataset_ED.loc[(Dataset_ED["Dr Seen Date"] > currentArrivalDate) & (Dataset_ED["Arrival Date"] <= currentArrivalDate)][["Arrival Date", "MRN", "Presentation Visit Number", "Triage Priority", "Dr Seen Date"]]
-    CurrentPresentations["Datetime"] += [currentArrivalDate for k in range(len(current_presentations))]
-    CurrentPresentations["Presentation Visit Number"] += [current_presentations.iloc[k]["Presentation Visit Number"] for k in range(len(current_presentations))]
-    CurrentPresentations["MRN"] += [current_presentations.iloc[k]["MRN"] for k in range(len(current_presentations))]
-    CurrentPresentations["Triage Priority"] += [current_presentations.iloc[k]["Triage Priority"] for k in range(len(current_presentations))]
-    CurrentPresentations["Arrival Date"] += [current_presentations.iloc[k]["Arrival Date"] for k in range(len(current_presentations))]
-    CurrentPresentations["Expected Dr Seen"] += [current_presentations.iloc[k]["Arrival Date"] + datetime.timedelta(minutes=triageTimeLimit[current_presentations.iloc[k]["Triage Priority"]-1]) for k in range(len(current_presentations))]
-    CurrentPresentations["Actual Dr Seen"] += [current_presentations.iloc[k]["Dr Seen Date"] for k in range(len(current_presentations))]
-    for j in range(1, 6):
-        TriagePriorityCount["Triage {} count".format(j)][i] = len(current_presentations.loc[(current_presentations["Arrival Date"] < currentArrivalDate) & (current_presentations["Triage Priority"] == j)])
-    TotalPatientsInEDAtArrival[i] = sum([TriagePriorityCount["Triage {} count".format(j)][i] for j in range(1, 6)])
-        
-Dataset_ED["TotalPatientsInEDWaitRoom"] = TotalPatientsInEDAtArrival
-for key in TriagePriorityCount.keys():
-    Dataset_ED[key] = TriagePriorityCount[key]
-CurrentPresentationsDf = pd.DataFrame(CurrentPresentations)
-
-Dataset_ED["Expected Dr Seen"] = [Dataset_ED.iloc[i]["Arrival Date"] + datetime.timedelta(minutes=triageTimeLimit[Dataset_ED.iloc[i]["Triage Priority"]-1]) for i in range(len(Dataset_ED))]
-
-# calculate relative order of priority for each presentation instance
-for date in list(CurrentPresentationsDf["Datetime"].unique()):
-    currentPresentations = CurrentPresentationsDf.loc[CurrentPresentationsDf["Datetime"]==date]
-    rankingActual = currentPresentations["Actual Dr Seen"].rank(method="first", ascending=True)
-    CurrentPresentationsDf.loc[CurrentPresentationsDf["Datetime"]==date, "Actual Ranking"] = rankingActual
-    rankingExpected = currentPresentations["Expected Dr Seen"].rank(method="first", ascending=True)
-    CurrentPresentationsDf.loc[CurrentPresentationsDf["Datetime"]==date, "Expected Ranking"] = rankingExpected
-
-# calculate population treated after their expected ordering
-treatedLaterThanOrdering = CurrentPresentationsDf.loc[CurrentPresentationsDf["Actual Ranking"] > CurrentPresentationsDf["Expected Ranking"]][["MRN", "Presentation Visit Number"]].drop_duplicates(subset=["MRN", "Presentation Visit Number"], keep="first")
-
-# add flag to transformed dataset
-Dataset_ED = Dataset_ED.merge(treatedLaterThanOrdering, how="left", on=["MRN", "Presentation Visit Number"], indicator=True)
-mask = Dataset_ED["_merge"] == "both"
-Dataset_ED.loc[mask, "TreatedLaterThanOrdering"] = 1
-Dataset_ED.loc[~mask, "TreatedLaterThanOrdering"] = 0
-Dataset_ED.drop(labels=["_merge"], axis="columns", inplace=True)
-
-# calculate total wait time between arrival and first doctor inspection
-Dataset_ED["TimeDiff Arrival-TreatDrNr (mins)"] = (Dataset_ED["Dr Seen Date"] - Dataset_ED["Arrival Date"]).dt.seconds/60.0
-
-# test calculations of minutes for arrival - departure and arrival - doctor inspection
-Dataset_ED["Calculated TimeDiff TreatDrNr-Act. Depart (mins)"] = (Dataset_ED["Depart Actual Date"] - Dataset_ED["Dr Seen Date"]).dt.seconds/60.0
-Dataset_ED["Check TreatDrNr-Act. Depart"] = Dataset_ED["Calculated TimeDiff TreatDrNr-Act. Depart (mins)"] == Dataset_ED["TimeDiff TreatDrNr-Act. Depart (mins)"]
-
-Dataset_ED["Calculated TimeDiff Arrival-Actual Depart (mins)"] = (Dataset_ED["Depart Actual Date"] - Dataset_ED["Arrival Date"]).dt.seconds/60.0
-Dataset_ED["Check Arrival-Actual Depart"] = Dataset_ED["Calculated TimeDiff Arrival-Actual Depart (mins)"] == Dataset_ED["TimeDiff Arrival-Actual Depart (mins)"]
-
-# test difference between triage priority time to be seen by a doctor recommendation vs dataset
-for i in range(1, 6):
-    mask = Dataset_ED["Triage Priority"]==i
-    Dataset_ED.loc[mask, "LateSeenByDr"] = Dataset_ED["TimeDiff Arrival-TreatDrNr (mins)"] - triageTimeLimit[i-1]
-
-# whether a person was late being seen by a doctor    
-Dataset_ED.loc[Dataset_ED["LateSeenByDr"] > 0, "LateFlag"] = 1
-Dataset_ED.loc[Dataset_ED["LateSeenByDr"] <= 0, "LateFlag"] = 0
-
-LatePopulation = Dataset_ED.loc[Dataset_ED["LateFlag"]==1]
-OnTimePopulation = Dataset_ED.loc[Dataset_ED["LateFlag"]==0]
-
-with pd.ExcelWriter("output.xlsx") as xWriter:
-    Dataset_ED.to_excel(xWriter, sheet_name="Dataset_ED_transformed", index=False)
-    CurrentPresentationsDf.to_excel(xWriter, sheet_name="ED Wait Room Timeline", index=False)
\ No newline at end of file
+
+def transformDataset(Dataset_ED, triageTimeLimit, report=None):
+    """Clean the Generic ED dataset and calculate metrics of interest.
+
+    Input:
+        Dataset_ED - Generic ED 2009 dataset
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+        report - RunReport the stages are recorded in, None records them in a throwaway report
+
+    Output:
+        Tuple of (transformed dataset, ED wait room timeline index), see Schema.py for dtypes and Timeline.expandTimeline for the full timeline
+    """
+    report = report or RunReport("transformDataset")
+
+    # drop unwanted data i.e. patients for deletion
+    with report.stage("clean", rowsIn=len(Dataset_ED)) as record:
+        Dataset_ED.drop(index=Dataset_ED.loc[Dataset_ED["Depart Status Code"].isin(["ZZ", "D"])].index, inplace=True)
+        record["rows out"] = len(Dataset_ED)
+
+    with report.stage("calendar columns", rowsIn=len(Dataset_ED)) as record:
+        # calculate hour value for each patient's arrival
+        Dataset_ED["Arrival Hour"] = Dataset_ED["Arrival Date"].dt.hour
+        # calculate month value for each patient's arrival
+        Dataset_ED["Arrival Month"] = Dataset_ED["Arrival Date"].dt.month
+        # calculate day of week value
+        Dataset_ED["Arrival Day Of Week"] = Dataset_ED["Arrival Date"].dt.dayofweek
+        record["rows out"] = len(Dataset_ED)
+
+    # calculate total patients in ED at the point of new patient's arrival
+    # generate table of patients currently presenting at each arrival time
+    # calculate ranking for dr seen to see where there is a discrepancy between the order in which a patient requires medical attention vs what actually happened
+    CurrentPresentationsDf = report.run("timeline", buildTimelineIndex, Dataset_ED, rowsIn=len(Dataset_ED))
+
+    # count patients waiting to be seen by a doctor at each arrival, overall and by triage priority
+    with report.stage("occupancy", rowsIn=len(Dataset_ED)) as record:
+        TriagePriorityCount = countPatientsAtArrival(Dataset_ED, startColumn="Arrival Date", endColumn="Dr Seen Date", groupColumn="Triage Priority", groupValues=range(1, 6))
+        Dataset_ED["TotalPatientsInEDWaitRoom"] = sum(TriagePriorityCount.values())
+        for j in range(1, 6):
+            Dataset_ED["Triage {} count".format(j)] = TriagePriorityCount[j]
+        record["rows out"] = len(Dataset_ED)
+
+    # expected Dr seen time, wait durations, duration checks and lateness against the triage time limits
+    Dataset_ED = report.run("derived features", deriveFeatures, Dataset_ED, triageTimeLimit, rowsIn=len(Dataset_ED))
+
+    # calculate relative order of priority for each presentation instance
+    CurrentPresentationsDf = report.run("ranking", rankTimelineIndex, CurrentPresentationsDf, Dataset_ED, rowsIn=len(CurrentPresentationsDf))
+
+    # add flag for population treated after their expected ordering to transformed dataset
+    Dataset_ED["TreatedLaterThanOrdering"] = report.run("treated later flag", flagTimelineIndex, Dataset_ED, CurrentPresentationsDf, rowsIn=len(CurrentPresentationsDf))
+
+    with report.stage("compact dtypes", rowsIn=len(Dataset_ED)) as record:
+        Dataset_ED = compactDataset(Dataset_ED)
+        CurrentPresentationsDf = compactTimeline(CurrentPresentationsDf)
+        record["rows out"] = len(Dataset_ED)
+
+    return Dataset_ED, CurrentPresentationsDf
+
+def loadTransformed(sourcePath=SOURCE_PATH, triageTimeLimit=triageTimeLimit, storeDir=STORE_DIR, storeFormat="parquet", processes=None, report=None):
+    """Load the transformed dataset and timeline from the store, transforming the source dataset only if it or the triage time limits changed.
+    Multi-site datasets, or any dataset when processes is given, are transformed by site x time window partition.
+
+    Input:
+        sourcePath - path to the source dataset
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+        storeDir - root directory of the columnar store
+        storeFormat - "parquet" or "feather"
+        processes - number of worker processes to transform partitions in
+        report - RunReport the stages are recorded in, None records them in a throwaway report
+
+    Output:
+        Tuple of (transformed dataset, ED wait room timeline index)
+    """
+    report = report or RunReport("loadTransformed")
+
+    key = report.run("source hash", sourceHash, sourcePath, triageTimeLimit)
+    tables = report.run("store read", loadTables, [DATASET_TABLE, TIMELINE_TABLE], storeDir, key, storeFormat)
+    if tables is None:
+        Dataset_ED = report.run("read source", pd.read_excel, sourcePath, sheet_name="Generic ED Data")
+        if processes or SITE_COLUMN in Dataset_ED.columns:
+            Dataset_ED, CurrentPresentationsDf = transformPartitioned(Dataset_ED, triageTimeLimit, transformDataset, processes=processes, report=report)
+        else:
+            Dataset_ED, CurrentPresentationsDf = transformDataset(Dataset_ED, triageTimeLimit, report)
+        tables = {DATASET_TABLE: Dataset_ED, TIMELINE_TABLE: CurrentPresentationsDf}
+        report.run("store write", saveTables, tables, storeDir, key, storeFormat, rowsIn=len(Dataset_ED))
+        # the interval index is kept next to the tables for point in time and range queries in interactive sessions
+        report.run("interval index", lambda: saveIntervalIndex(buildIntervalIndex(Dataset_ED), storeDir, key), rowsIn=len(Dataset_ED))
+        report.run("aggregation cube", lambda: saveCube(buildCube(Dataset_ED), storeDir, key), rowsIn=len(Dataset_ED))
+
+    return tables[DATASET_TABLE], tables[TIMELINE_TABLE]
+
+def loadIntervals(sourcePath=SOURCE_PATH, triageTimeLimit=triageTimeLimit, storeDir=STORE_DIR, storeFormat="parquet"):
+    """Load the interval index of the transformed dataset, see Intervals.py. It is built and stored on first use for stores written without one.
+
+    Output:
+        Interval index, query results are row positions into the transformed dataset from loadTransformed
+    """
+    key = sourceHash(sourcePath, triageTimeLimit)
+    index = loadIntervalIndex(storeDir, key)
+    if index is None:
+        index = buildIntervalIndex(loadTransformed(sourcePath, triageTimeLimit, storeDir, storeFormat)[0])
+        saveIntervalIndex(index, storeDir, key)
+
+    return index
+
+def loadAggregationCube(sourcePath=SOURCE_PATH, triageTimeLimit=triageTimeLimit, storeDir=STORE_DIR, storeFormat="parquet"):
+    """Load the aggregation cube of the transformed dataset, see Cube.py. It is built and stored on first use for stores written without one.
+
+    Output:
+        Aggregation cube for Cube.rollUp
+    """
+    key = sourceHash(sourcePath, triageTimeLimit)
+    cube = loadCube(storeDir, key)
+    if cube is None:
+        cube = buildCube(loadTransformed(sourcePath, triageTimeLimit, storeDir, storeFormat)[0])
+        saveCube(cube, storeDir, key)
+
+    return cube
+
+def appendTransformed(newSourcePath, sourcePath=SOURCE_PATH, triageTimeLimit=triageTimeLimit, storeDir=STORE_DIR, key=None):
+    """Append newly arrived records to the incremental store, seeding it from the full source dataset on first use.
+    The new dataset rows, timeline rows, reflagged positions and interval index are appended as new parts and the aggregation cube is updated
+    cell by cell, so runtime scales with the new records and the patients waiting at the watermark, not with the history. Load the store with
+    Incremental.loadIncremental.
+
+    Input:
+        newSourcePath - path to a workbook of records arriving after the latest stored arrival
+        sourcePath - path to the source dataset used to seed the incremental store
+        triageTimeLimit - list of minutes within which triage priorities 1 to 5 should be seen
+        storeDir - root directory of the columnar store
+        key - key of the incremental store, defaults to Store.incrementalKey of the triage time limits
+
+    Output:
+        Tuple of (transformed new rows, new timeline index rows)
+    """
+    key = key or incrementalKey(triageTimeLimit)
+    state = loadState(storeDir, key)
+    if state is None:
+        # a store without current state is reseeded from scratch, parts written by an earlier version are not appended to
+        shutil.rmtree(os.path.join(storeDir, key), ignore_errors=True)
+        Dataset_ED, CurrentPresentationsDf = loadTransformed(sourcePath, triageTimeLimit, storeDir)
+        appendTable(Dataset_ED, storeDir, key, DATASET_TABLE)
+        appendTable(CurrentPresentationsDf, storeDir, key, TIMELINE_TABLE)
+        appendTable(pd.DataFrame({"Position": np.array([], dtype="int64")}), storeDir, key, REFLAGGED_TABLE)
+        appendIntervalIndex(buildIntervalIndex(Dataset_ED), storeDir, key)
+        saveCube(buildCube(Dataset_ED), storeDir, key)
+        state = incrementalState(Dataset_ED)
+
+    newRecords = pd.read_excel(newSourcePath, sheet_name="Generic ED Data")
+    waiting, positions, rows = state["waiting"], state["positions"], state["rows"]
+    # multi-site records are ranked within each site, as loadTransformed transforms the seed and any full recompute
+    transform = partial(transformPartitioned, transformDataset=transformDataset) if SITE_COLUMN in newRecords.columns else transformDataset
+    deltaDataset, deltaTimeline, reflagged, state = transformIncrement(newRecords, state, triageTimeLimit, transform)
+    moved = pd.MultiIndex.from_arrays([waiting["MRN"], waiting["Presentation Visit Number"]]).isin(reflagged)
+
+    # a cube stored by an earlier version is rebuilt from the stored rows before the new parts are appended. The cube is read into memory
+    # rather than memory mapped, as saveCube replaces its directory
+    cube = loadCube(storeDir, key, memoryMap=False) or buildCube(loadIncremental(storeDir, key)[0])
+    appendTable(deltaDataset, storeDir, key, DATASET_TABLE)
+    appendTable(deltaTimeline, storeDir, key, TIMELINE_TABLE)
+    if moved.any():
+        appendTable(pd.DataFrame({"Position": positions[moved]}), storeDir, key, REFLAGGED_TABLE)
+    appendIntervalIndex(buildIntervalIndex(deltaDataset, offset=rows), storeDir, key)
+    # the new rows are added to the cube and the reflagged rows moved to their treated later cells
+    saveCube(addCubes([cube, buildCube(deltaDataset), buildCube(waiting.loc[moved].assign(TreatedLaterThanOrdering=True)), buildCube(waiting.loc[moved])], [1, 1, 1, -1]), storeDir, key)
+    saveState(state, storeDir, key)
+
+    return deltaDataset, deltaTimeline
+
+if __name__ == "__main__":
+    report, reportPath = reportFromArguments("Transformation")
+
+    processes = int(sys.argv[sys.argv.index("--processes") + 1]) if "--processes" in sys.argv else None
+    if "--append" in sys.argv:
+        report.run("append", appendTransformed, sys.argv[sys.argv.index("--append") + 1])
+        storeKey = incrementalKey(triageTimeLimit)
+    else:
+        storeKey = sourceHash(SOURCE_PATH, triageTimeLimit)
+        loadTransformed(processes=processes, report=report)
+
+    # optional Excel and gzip CSV exports, the columnar store is the interchange format between scripts
+    # the timeline is expanded chunk by chunk while it is written, tables longer than a sheet continue on numbered sheets
+    if "--excel" in sys.argv or "--csv" in sys.argv:
+        tables = dict(zip([DATASET_TABLE, TIMELINE_TABLE], loadIncremental(STORE_DIR, storeKey))) if "--append" in sys.argv else loadTables([DATASET_TABLE, TIMELINE_TABLE], STORE_DIR, storeKey)
+    if "--excel" in sys.argv:
+        with report.stage("excel export", rowsIn=len(tables[TIMELINE_TABLE])) as record:
+            writeExcel("output.xlsx", {"Dataset_ED_transformed": tables[DATASET_TABLE], "ED Wait Room Timeline": timelineChunks(tables[TIMELINE_TABLE], tables[DATASET_TABLE])})
+            record["rows out"] = len(tables[DATASET_TABLE]) + len(tables[TIMELINE_TABLE])
+    if "--csv" in sys.argv:
+        with report.stage("csv export", rowsIn=len(tables[TIMELINE_TABLE])) as record:
+            writeCsv(EXPORT_DIR, {"Dataset_ED_transformed": tables[DATASET_TABLE], "ED Wait Room Timeline": timelineChunks(tables[TIMELINE_TABLE], tables[DATASET_TABLE])}, processes=processes)
+            record["rows out"] = len(tables[DATASET_TABLE]) + len(tables[TIMELINE_TABLE])
+
+    report.write(reportPath)